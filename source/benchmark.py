@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic_dataset import generate_dataset
+
+# Stages shown in the summary table, in pipeline order. The JSON summary contains every span of the run report
+SUMMARY_STAGES = ["video_decode", "frame_analysis", "filter_gaps", "detect_outliers", "cluster_analysis",
+                  "gaze_to_frame", "write_output"]
+
+
+def get_subset(results_path, subset_path, subjects):
+    """
+    Make a results directory with the first subjects of results_path.
+    The subject folders are linked, or copied where symbolic links are not available
+    """
+    if os.path.isdir(subset_path):
+        shutil.rmtree(subset_path)
+    os.makedirs(subset_path)
+
+    for subject in sorted(os.listdir(results_path))[:subjects]:
+        try:
+            os.symlink(os.path.abspath(os.path.join(results_path, subject)), os.path.join(subset_path, subject),
+                       target_is_directory=True)
+        except OSError:
+            shutil.copytree(os.path.join(results_path, subject), os.path.join(subset_path, subject))
+
+    return subset_path
+
+
+def remove_derived_files(results_path, cache_path):
+    """
+    Remove the cache and the surface position sidecars so that every run starts cold
+    """
+    if os.path.isdir(cache_path):
+        shutil.rmtree(cache_path)
+
+    for root, dirs, files in os.walk(results_path, followlinks=True):
+        for name in files:
+            if name.endswith(".npy"):
+                os.remove(os.path.join(root, name))
+
+
+def run_pipeline(videos_path, results_path, output_path, cache_path, workers, cold=True):
+    """
+    Run main.py on a dataset in a new process.
+    Returns the wall time in seconds and the run report of main.py
+    """
+    if cold:
+        remove_derived_files(results_path, cache_path)
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+
+    report_path = output_path + "_report.json"
+    env = dict(os.environ,
+               GAZE_TEST_VIDEO_FOLDER=videos_path,
+               GAZE_RESULTS_DIRECTORY=results_path,
+               GAZE_CACHE_DIRECTORY=cache_path)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), output_path,
+               "--workers", str(workers), "--force", "--report", report_path]
+    if cold:
+        command.append("--no-cache")
+
+    start = time.perf_counter()
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+
+    with open(report_path) as report_file:
+        report = json.load(report_file)
+
+    # main.py reports failed tasks without failing itself, a run with failures is not a valid timing
+    if report["failed_tasks"]:
+        raise RuntimeError("{} tasks failed in {}: {}".format(len(report["failed_tasks"]), output_path,
+                                                              ", ".join(report["failed_tasks"])))
+
+    return elapsed, report
+
+
+def print_summary(results):
+    header = "{:>8} {:>7} {:>8} {:>7} {:>8}".format("subjects", "workers", "wall s", "frames", "frames/s")
+    header += "".join(" {:>15}".format(x) for x in SUMMARY_STAGES)
+    print(header)
+    for result in results:
+        frames = result["report"]["total"]["counters"].get("frames_decoded", 0)
+        spans = result["report"]["total"]["spans"]
+        line = "{:>8} {:>7} {:>8.2f} {:>7} {:>8.1f}".format(result["subjects"], result["workers"], result["seconds"],
+                                                            frames, frames / result["seconds"])
+        line += "".join(" {:>15.2f}".format(spans.get(x, {}).get("seconds", 0.)) for x in SUMMARY_STAGES)
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time the pipeline on synthetic datasets of different sizes "
+                                                 "with different worker counts")
+    parser.add_argument("--root", default=None,
+                        help="Directory for the dataset and outputs. A temporary directory is used by default")
+    parser.add_argument("--subjects", default="1,2,4", help="Comma separated dataset sizes in subjects")
+    parser.add_argument("--workers", default="1,2,4", help="Comma separated worker counts")
+    parser.add_argument("--videos", type=int, default=8, help="Test videos per subject")
+    parser.add_argument("--video-frames", type=int, default=60, help="Frames per test video")
+    parser.add_argument("--warm", action="store_true",
+                        help="Keep the calibration cache and the surface sidecars between runs")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    subject_counts = [int(x) for x in args.subjects.split(",")]
+    worker_counts = [int(x) for x in args.workers.split(",")]
+
+    root = args.root or tempfile.mkdtemp(prefix="gaze_benchmark_")
+    dataset_path = os.path.join(root, "dataset")
+    if not os.path.isdir(os.path.join(dataset_path, "results")) or \
+            len(os.listdir(os.path.join(dataset_path, "results"))) < max(subject_counts):
+        print("Generating {} subjects in {}".format(max(subject_counts), dataset_path))
+        generate_dataset(dataset_path, max(subject_counts), args.videos, args.video_frames)
+    videos_path = os.path.join(dataset_path, "videos")
+
+    results = []
+    for subjects in subject_counts:
+        results_path = get_subset(os.path.join(dataset_path, "results"),
+                                  os.path.join(root, "results_{}".format(subjects)), subjects)
+        for workers in worker_counts:
+            seconds, report = run_pipeline(videos_path, results_path,
+                                           os.path.join(root, "output_{}_{}".format(subjects, workers)),
+                                           os.path.join(root, "cache"), workers, not args.warm)
+            print("{} subjects, {} workers: {:.2f} s".format(subjects, workers, seconds))
+            results.append({"subjects": subjects, "workers": workers, "seconds": seconds, "report": report})
+
+    print_summary(results)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import pickle
+
+import config as cfg
+
+# Bump this when a cached computation changes so that old entries are not used
+CACHE_VERSION = 3
+
+# The config values each cached stage depends on. Later stages include the values of earlier ones
+INTERVAL_CONFIG = ["CALIBRATION_POINTS_AMOUNT",
+                   "CALIBRATION_POINT_LOCATIONS",
+                   "CALIBRATION_SYMBOL_RADIUS",
+                   "SYMBOL_VISIBILITY_THRESHOLD",
+                   "SYMBOL_FADE_OUT_THRESHOLD",
+                   "FRAME_SAMPLING"]
+
+ERROR_CONFIG = INTERVAL_CONFIG + ["CALIBRATION_POINT_NAMES",
+                                  "GAZE_STAMP_THRESHOLD",
+                                  "GAP_THRESHOLD",
+                                  "MISSING_MEASUREMENT_THRESHOLD",
+                                  "BLINK_REMOVE_THRESHOLD",
+                                  "OUTLIER_METHOD"]
+
+AVERAGE_CONFIG = ERROR_CONFIG + ["CLUSTER_THRESHOLD_WIDTH",
+                                 "CLUSTER_THRESHOLD_HEIGHT",
+                                 "CLUSTER_PERCENTAGE_THRESHOLD",
+                                 "MAX_CLUSTERS",
+                                 "CLUSTER_MODE"]
+
+# The config values the corrected gaze output of a video depends on in addition to the calibration averages
+OUTPUT_CONFIG = AVERAGE_CONFIG + ["TEST_VIDEO_FOLDER",
+                                  "VIDEO_METADATA_OVERRIDES",
+                                  "CALIBRATION_CHECK_INTERVAL"]
+
+
+# The modules that compute the corrected gaze output. Scripts that only read the output,
+# like the heatmaps and the benchmark, are not included so that changing them does not rebuild every output
+OUTPUT_MODULES = ["calibration_cache.py",
+                  "compress_gaze_points.py",
+                  "detect_outliers.py",
+                  "export_files.py",
+                  "filter_gaps.py",
+                  "frame_analysis.py",
+                  "gaze_to_frame.py",
+                  "get_calibration_error.py",
+                  "get_calibration_point_intervals.py",
+                  "get_correction_func.py",
+                  "get_starting_frame.py",
+                  "get_video_order.py",
+                  "surface_positions.py",
+                  "video_metadata.py"]
+
+
+def get_recording_files(location, recording):
+    """
+    Returns the input files of a recording: the world video and every file of the export
+    """
+    recording_path = os.path.join(location, recording)
+    files = [os.path.join(recording_path, "world.mp4")]
+
+    exports_path = os.path.join(recording_path, "exports")
+    for root, dirs, filenames in os.walk(exports_path):
+        dirs.sort()
+        # The surface position sidecars are derived from the csv files
+        files.extend(os.path.join(root, x) for x in sorted(filenames) if not x.endswith(".npy"))
+
+    return files
+
+
+def file_signature(path):
+    """
+    Identify the contents of a file by size and modification time,
+    or by a hash of the contents if cfg.CACHE_HASH_CONTENTS is set
+    """
+    if not os.path.isfile(path):
+        return path, None
+
+    if cfg.CACHE_HASH_CONTENTS:
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return os.path.basename(path), digest.hexdigest()
+
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def get_cache_key(stage, files, config_names, extra=(), signatures=()):
+    """
+    Build a cache key from the stage name, the input files, the config values the stage
+    depends on and any extra arguments.
+    signatures are file_signature() results of input files shared by many keys, they come before files
+    """
+    parts = [CACHE_VERSION, stage,
+             list(signatures) + [file_signature(x) for x in files],
+             [(name, getattr(cfg, name)) for name in config_names],
+             list(extra)]
+
+    return "{}_{}".format(stage, hashlib.sha1(repr(parts).encode()).hexdigest())
+
+
+def get_code_version():
+    """
+    A hash of the source files the corrected gaze output depends on, so that results are rebuilt when the code
+    changes. The config values are part of the keys separately
+    """
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for name in OUTPUT_MODULES:
+        with open(os.path.join(source_dir, name), "rb") as f:
+            digest.update(name.encode())
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def get_cache_path(key):
+    return os.path.join(cfg.CACHE_DIRECTORY, key + ".pkl")
+
+
+def cached(stage, files, config_names, compute, extra=(), use_cache=True):
+    """
+    Return the cached result of compute() for the given inputs, or compute and store it.
+    use_cache=False bypasses the cache completely
+    """
+    if not use_cache:
+        return compute()
+
+    cache_path = get_cache_path(get_cache_key(stage, files, config_names, extra))
+
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "rb") as cache_file:
+                result = pickle.load(cache_file)
+            # Mark as recently used for eviction
+            os.utime(cache_path)
+            return result
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+    result = compute()
+
+    try:
+        if not os.path.isdir(cfg.CACHE_DIRECTORY):
+            os.makedirs(cfg.CACHE_DIRECTORY, exist_ok=True)
+
+        # Write through a temporary file so that other workers never read a partial entry
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, "wb") as cache_file:
+            pickle.dump(result, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+        evict()
+    except OSError as e:
+        print("Could not write cache entry", cache_path, e)
+
+    return result
+
+
+def evict(max_size=None):
+    """
+    Remove the least recently used cache entries until the cache is smaller than max_size bytes
+    """
+    if max_size is None:
+        max_size = cfg.CACHE_MAX_SIZE
+
+    entries = []
+    for item in os.listdir(cfg.CACHE_DIRECTORY):
+        if item.endswith(".pkl"):
+            stat = os.stat(os.path.join(cfg.CACHE_DIRECTORY, item))
+            entries.append((stat.st_mtime, stat.st_size, item))
+
+    total = sum(x[1] for x in entries)
+    for mtime, size, item in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cfg.CACHE_DIRECTORY, item))
+        except OSError:
+            # Another worker removed it already
+            pass
+        total -= size
+
+
+def clear_cache():
+    """
+    Remove every cache entry
+    """
+    if os.path.isdir(cfg.CACHE_DIRECTORY):
+        evict(0)
@@ -1,27 +1,56 @@
+import numpy as np
+
+
+def group_by_frame(frames, x, y, weights=None, method="mean"):
+    """
+    Reduce gaze points on the same frame into a single point.
+    frames, x and y are arrays of equal length, the frames do not need to be sorted
+    weights is an optional array of per point weights, eg. the confidence column
+    method is "mean" or "median". When weights are given, "mean" is a weighted average
+    Returns the frame indices, the reduced x and y coordinates and the number of points
+    in each frame as arrays, ordered by frame
+    """
+    frames = np.asarray(frames)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    unique_frames, inverse, counts = np.unique(frames, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+
+    if method == "mean":
+        if weights is None:
+            out_x = np.bincount(inverse, weights=x, minlength=len(unique_frames)) / counts
+            out_y = np.bincount(inverse, weights=y, minlength=len(unique_frames)) / counts
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            weight_sum = np.bincount(inverse, weights=weights, minlength=len(unique_frames))
+            # Frames with zero total weight get NaN coordinates
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out_x = np.bincount(inverse, weights=weights * x, minlength=len(unique_frames)) / weight_sum
+                out_y = np.bincount(inverse, weights=weights * y, minlength=len(unique_frames)) / weight_sum
+    elif method == "median":
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        low = starts + (counts - 1) // 2
+        high = starts + counts // 2
+
+        # Sort the points by frame and by value inside each frame, then pick the middle points
+        sorted_x = x[np.lexsort((x, inverse))]
+        sorted_y = y[np.lexsort((y, inverse))]
+        out_x = (sorted_x[low] + sorted_x[high]) / 2
+        out_y = (sorted_y[low] + sorted_y[high]) / 2
+    else:
+        raise ValueError("Unknown reduction method: {}".format(method))
+
+    return unique_frames, out_x, out_y, counts
+
+
 def compress_gaze_points(data):
     """
     Calculate the averages of gaze points on the same frame and
     return compressed gaze data.
+    data contains rows of frame index, timestamp, x and y
     """
+    data = np.asarray(data, dtype=np.float64)
+    frames, avg_x, avg_y, _ = group_by_frame(data[:, 0].astype(np.int64), data[:, 2], data[:, 3])
 
-    tmp_data = []
-    frame = int(data[0][0])
-    sum_x = 0
-    sum_y = 0
-    points_in_frame = 0
-
-    for row in data:
-        if frame == int(row[0]):
-            sum_x += float(row[2])
-            sum_y += float(row[3])
-            points_in_frame += 1
-        else:
-            avg_x = sum_x / points_in_frame
-            avg_y = sum_y / points_in_frame
-            tmp_data.append([frame, avg_x, avg_y])
-            points_in_frame = 1
-            frame = int(row[0])
-            sum_x = float(row[2])
-            sum_y = float(row[3])
-
-    return tmp_data
+    return [[frame, x, y] for frame, x, y in zip(frames.tolist(), avg_x.tolist(), avg_y.tolist())]
@@ -1,9 +1,20 @@
 # Config for eye tracking data processing
 
+from os import environ
 from os.path import isdir
 
+# The directories below can also be set with the environment variables GAZE_TEST_VIDEO_FOLDER,
+# GAZE_RESULTS_DIRECTORY, GAZE_OUTPUT_DIRECTORY and GAZE_CACHE_DIRECTORY, eg. to run on a synthetic dataset
+
 # The path to original video files used in experiment
-TEST_VIDEO_FOLDER = r"D:\Raw_Files\eye_tracking_final_sequences_y4m"
+TEST_VIDEO_FOLDER = environ.get("GAZE_TEST_VIDEO_FOLDER", r"D:\Raw_Files\eye_tracking_final_sequences_y4m")
+
+# Corrections to the metadata read from the test videos, by video file name
+# The fps of these videos in their file names or headers does not match the shown frame rate
+VIDEO_METADATA_OVERRIDES = {
+    "oldTownCross_1920x1080_60.y4m": {"fps": 50},
+    "rushHour_1920x1080_50.y4m": {"fps": 25},
+}
 
 # List of test subjects to ignore
 # Add subjects with defective data
@@ -19,9 +30,27 @@ IGNORE_PERSON = ['0-f-35',
 CALIBRATION_CHECK_INTERVAL = 5
 
 # The directory which contains the results for each subject
-RESULTS_DIRECTORY = r"D:\test\eye_track_results"
+RESULTS_DIRECTORY = environ.get("GAZE_RESULTS_DIRECTORY", r"D:\test\eye_track_results")
+
+DEFAULT_OUTPUT_DIRECTORY = environ.get("GAZE_OUTPUT_DIRECTORY", r"D:\test\exports")
+
+# Format of the corrected gaze data written by main.py
+# "csv": frame_index,x_coord,y_coord text files
+# "npz": NumPy archives with int32 frame_index and float32 x_coord and y_coord arrays
+# The per subject folders link to the files in the per video folders and
+# manifest.json in the output directory lists every written file
+OUTPUT_FORMAT = "csv"
+
+# Calibration analysis results (intervals, errors and cluster averages) are cached here
+# between runs. Run main.py with --no-cache to bypass or --clear-cache to empty the cache
+CACHE_DIRECTORY = environ.get("GAZE_CACHE_DIRECTORY", r"D:\test\cache")
+
+# Least recently used cache entries are removed when the cache grows over this size in bytes
+CACHE_MAX_SIZE = 1024 ** 3
 
-DEFAULT_OUTPUT_DIRECTORY = r"D:\test\exports"
+# Identify input files by a hash of their contents instead of their size and modification time
+# Slower, but survives copying the data to another location
+CACHE_HASH_CONTENTS = False
 
 # The amount of calibration points in calibration checks
 CALIBRATION_POINTS_AMOUNT = 5
@@ -71,6 +100,16 @@ CLUSTER_PERCENTAGE_THRESHOLD = 0.9
 # Bigger numbers increase processing time.
 MAX_CLUSTERS = 5
 
+# "exact": full KMeans fits and the pairwise silhouette score for every cluster count
+# "fast": KMeans fits warm started from the previous cluster count and a silhouette score computed from
+# the distances to the cluster centers. Run get_correction_func.py on subject folders to compare the modes
+CLUSTER_MODE = "exact"
+
+# Outlier detection of the gaze error points of each calibration point
+# "lof": LocalOutlierFactor with 10 neighbours
+# "knn": a point is an outlier if fewer than 3 other points are within 0.02 of it. Cheaper than "lof"
+OUTLIER_METHOD = "lof"
+
 # CLUSTERING - END
 
 # GAP FILTERING variables
@@ -82,6 +121,9 @@ GAP_THRESHOLD = 0.1
 MISSING_MEASUREMENT_THRESHOLD = 5
 # This amount in seconds is removed before and after a detected gap
 BLINK_REMOVE_THRESHOLD = 0.2
+# In streaming mode a gaze sample waits at most this many seconds (of gaze time) for the gaps after it.
+# Longer delays make the blink removal match the exported data more closely
+STREAM_MAX_DELAY = 1.0
 
 # GAP FILTERING - END
 
@@ -98,6 +140,14 @@ SYMBOL_VISIBILITY_THRESHOLD = 30
 # After becoming visible, when the minimum is over this value the point is considered to be faded out
 SYMBOL_FADE_OUT_THRESHOLD = 50
 
+# How world video frames are mapped to screen space during frame analysis
+# "roi": only the pixels needed by the detectors are mapped through the surface transform
+# "warp": every frame is warped to screen space in full. Use this to check the results of "roi"
+FRAME_SAMPLING = "roi"
+
+# With "roi" sampling, the screen brightness is averaged over a grid with this spacing in pixels
+SCREEN_MEAN_GRID_STEP = 8
+
 # CALIBRATION POINT INTERVAL - END
 
 # Check validity of config values. Return 'False' if invalid values found
@@ -139,6 +189,14 @@ def config_check():
         print("MAX_CLUSTERS must be at least 2")
         valid = False
 
+    if CLUSTER_MODE not in ("exact", "fast"):
+        print("CLUSTER_MODE must be either 'exact' or 'fast'")
+        valid = False
+
+    if OUTLIER_METHOD not in ("lof", "knn"):
+        print("OUTLIER_METHOD must be either 'lof' or 'knn'")
+        valid = False
+
     if GAZE_STAMP_THRESHOLD < 0:
         print("GAZE_STAMP_THRESHOLD must be positive")
         valid = False
@@ -155,4 +213,24 @@ def config_check():
         print("BLINK_REMOVE_THRESHOLD must be positive")
         valid = False
 
+    if STREAM_MAX_DELAY < BLINK_REMOVE_THRESHOLD:
+        print("STREAM_MAX_DELAY must be at least BLINK_REMOVE_THRESHOLD")
+        valid = False
+
+    if OUTPUT_FORMAT not in ("csv", "npz"):
+        print("OUTPUT_FORMAT must be either 'csv' or 'npz'")
+        valid = False
+
+    if CACHE_MAX_SIZE < 0:
+        print("CACHE_MAX_SIZE must be positive")
+        valid = False
+
+    if FRAME_SAMPLING not in ("roi", "warp"):
+        print("FRAME_SAMPLING must be either 'roi' or 'warp'")
+        valid = False
+
+    if SCREEN_MEAN_GRID_STEP < 1:
+        print("SCREEN_MEAN_GRID_STEP must be at least 1")
+        valid = False
+
     return valid
@@ -1,4 +1,88 @@
-from sklearn.neighbors import LocalOutlierFactor
+import numpy as np
+from sklearn.neighbors import KDTree, LocalOutlierFactor
+
+import config as cfg
+from instrumentation import span
+
+
+def separate_groups(groups):
+    """
+    Place the groups of points side by side along the x axis so that every point is closer
+    to the points of its own group than to any point of another group.
+    Returns the stacked points and the start offset of each group
+    """
+    groups = [np.asarray(x, dtype=np.float64).reshape(-1, 2) for x in groups]
+    offsets = np.concatenate(([0], np.cumsum([len(x) for x in groups])))
+
+    # Gap between the groups is larger than the diameter of any group
+    spacing = max((np.ptp(x[:, 0]) + np.ptp(x[:, 1]) for x in groups if len(x)), default=0.) * 2 + 1
+
+    shifted = []
+    for i, group in enumerate(groups):
+        group = group.copy()
+        if len(group):
+            group[:, 0] += i * spacing - group[:, 0].min()
+        shifted.append(group)
+
+    return np.concatenate(shifted) if shifted else np.zeros((0, 2)), offsets
+
+
+def lof_masks(groups, k=10):
+    """
+    Local outlier factor of several groups of points in one fit.
+    Groups with k points or less are fitted separately since their neighbourhoods would reach other groups
+    """
+    masks = [np.zeros(len(x), dtype=bool) for x in groups]
+
+    large = [i for i, x in enumerate(groups) if len(x) > k]
+    for i, group in enumerate(groups):
+        if 1 < len(group) <= k:
+            masks[i] = LocalOutlierFactor(n_neighbors=k).fit_predict(np.asarray(group).reshape(-1, 2)) == -1
+
+    if large:
+        data, offsets = separate_groups([groups[i] for i in large])
+        pred = LocalOutlierFactor(n_neighbors=k).fit_predict(data) == -1
+        for n, i in enumerate(large):
+            masks[i] = pred[offsets[n]:offsets[n + 1]]
+
+    return masks
+
+
+def knn_masks(groups, k=3, threshold=0.02):
+    """
+    A point is an outlier if fewer than k other points of its group are within threshold of it.
+    All groups are queried from a single KD-tree
+    """
+    data, offsets = separate_groups(groups)
+    if len(data) == 0:
+        return [np.zeros(0, dtype=bool) for _ in groups]
+
+    neighbours = KDTree(data).query_radius(data, r=threshold, count_only=True) - 1
+    outliers = neighbours < k
+
+    return [outliers[offsets[i]:offsets[i + 1]] for i in range(len(groups))]
+
+
+@span("detect_outliers")
+def detect_outlier_masks(groups, method=None, k=None, threshold=0.02):
+    """
+    Detect outliers in several groups of points, eg. the gaze errors of every calibration point
+    of a calibration, in one batched call.
+    groups is a list of (N, 2) arrays
+    method is "lof" for LocalOutlierFactor or "knn" for a k-NN distance threshold, cfg.OUTLIER_METHOD by default
+    k is the number of neighbours, 10 for "lof" and 3 for "knn" by default
+    threshold is the neighbour distance of the "knn" method
+    Returns a list of boolean masks, True for the outlying points
+    """
+    if method is None:
+        method = cfg.OUTLIER_METHOD
+
+    if method == "lof":
+        return lof_masks(groups, 10 if k is None else k)
+    if method == "knn":
+        return knn_masks(groups, 3 if k is None else k, threshold)
+
+    raise ValueError("Unknown outlier detection method: {}".format(method))
 
 
 def detect_outliers(points, k=10):
@@ -7,13 +91,4 @@ def detect_outliers(points, k=10):
     Use LocalOutlierFactor to for detection.
     Returns an array of indexes of outlying points.
     """
-    outlier_indices = []
-
-    clf = LocalOutlierFactor(n_neighbors=k)
-    pred = clf.fit_predict(points)
-
-    for idx, i in enumerate(pred):
-        if i == -1:
-            outlier_indices.append(idx)
-
-    return outlier_indices
+    return np.flatnonzero(lof_masks([points], k)[0])
@@ -0,0 +1,56 @@
+import os
+import warnings
+
+import numpy as np
+
+from instrumentation import count, span
+
+
+def get_surfaces_dir(location, recording="000"):
+    """
+    Returns the path of the surfaces folder inside the Pupil export of a recording.
+    location is the base directory of the recording, not including the '000'
+    recording is the number of the recording
+    """
+    exports_path = os.path.join(location, recording, "exports")
+    assert (len(os.listdir(exports_path)) == 1)  # Make sure there is exactly one export result
+
+    return os.path.join(exports_path, os.listdir(exports_path)[0], "surfaces")
+
+
+def get_export_file(location, recording, prefix):
+    """
+    Returns the path of the first export file whose name starts with prefix,
+    eg. "srf_", "gaze_" or "fixations_". Returns None if no such file exists.
+    """
+    surfaces_path = get_surfaces_dir(location, recording)
+    for item in sorted(os.listdir(surfaces_path)):
+        if item.startswith(prefix):
+            return os.path.join(surfaces_path, item)
+
+    return None
+
+
+@span("csv_parse")
+def read_export_columns(csv_file_path, columns, dtypes=None):
+    """
+    Read selected columns of a Pupil csv export (eg. gaze_* or fixations_*) into NumPy arrays.
+    Only the requested columns are converted, the rest of each row is skipped.
+    columns is a list of column indexes, eg. [WORLD_FRAME_IDX, GAZE_TIMESTAMP] from filter_gaps
+    dtypes is a list of NumPy types, one per column. Columns are float64 by default
+    Returns a list of arrays in the same order as columns
+    """
+    if dtypes is None:
+        dtypes = [np.float64] * len(columns)
+
+    with warnings.catch_warnings():
+        # An export without any rows is not an error, it just gives empty columns
+        warnings.simplefilter("ignore", UserWarning)
+        data = np.loadtxt(csv_file_path, delimiter=",", skiprows=1, usecols=columns,
+                          dtype=np.float64, ndmin=2)
+
+    if data.shape[1] != len(columns):
+        data = np.zeros((0, len(columns)), dtype=np.float64)
+    count("csv_rows_parsed", len(data))
+
+    return [data[:, i].astype(dtype) for i, dtype in enumerate(dtypes)]
@@ -1,6 +1,8 @@
-from csv import reader
+import numpy as np
 
 import config as cfg
+from export_files import read_export_columns
+from instrumentation import span
 
 # Index definitions
 WORLD_TIMESTAMP = 0
@@ -14,81 +16,62 @@ ON_SRF = 7
 CONFIDENCE = 8
 
 
+def find_gap_clusters(frames, timestamps, start_frame):
+    """
+    Find gaps (missing measurements) in the gaze timestamps and group them into clusters.
+    Only rows on or after start_frame can start a gap, the row before start_frame is still
+    used as the previous timestamp.
+    Returns the amount of gaps, the start timestamp and the end timestamp of each cluster as arrays
+    """
+    # A gap is a time step longer than GAZE_STAMP_THRESHOLD. The first row is compared to zero
+    previous_time = np.concatenate(([0.0], timestamps[:-1]))
+    gaps = timestamps[(frames >= start_frame) & (timestamps - previous_time > cfg.GAZE_STAMP_THRESHOLD)]
+
+    if len(gaps) == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(1), np.zeros(1)
+
+    # A new cluster starts when the previous gap is at least GAP_THRESHOLD away
+    breaks = np.flatnonzero(np.diff(gaps) >= cfg.GAP_THRESHOLD) + 1
+    first = np.concatenate(([0], breaks))
+    last = np.concatenate((breaks - 1, [len(gaps) - 1]))
+
+    # A lone gap that starts a new cluster at the very end of the data is not counted as a cluster
+    if len(breaks) and breaks[-1] == len(gaps) - 1:
+        first, last = first[:-1], last[:-1]
+
+    return last - first + 1, gaps[first], gaps[last]
+
+
+def find_gap_mask(frames, timestamps, start_frame):
+    """
+    Returns a boolean mask of the rows that are kept after blink removal.
+    Rows before start_frame are never kept.
+    """
+    counts, starts, ends = find_gap_clusters(frames, timestamps, start_frame)
+
+    # Every row is compared to the first cluster that has not ended before the row,
+    # rows after the last cluster are compared to the last cluster
+    cluster = np.minimum(np.searchsorted(ends, timestamps, side="left"), len(ends) - 1)
+
+    # Remove the rows around short or small gap clusters, these are caused by blinking
+    blink = (ends - starts < cfg.BLINK_REMOVE_THRESHOLD) | (counts < cfg.MISSING_MEASUREMENT_THRESHOLD)
+    eliminated = blink[cluster] \
+        & (timestamps > starts[cluster] - cfg.BLINK_REMOVE_THRESHOLD) \
+        & (timestamps < ends[cluster] + cfg.BLINK_REMOVE_THRESHOLD)
+
+    return (frames >= start_frame) & ~eliminated
+
+
+@span("filter_gaps")
 def filter_gaps(csv_file_path, start_frame):
     """
     Filters out gaps (missing measurements) in collected data. The goal is to filter out
     gaps caused by the subject blinking or random errors in pupil detection
+    Returns the world_frame_idx, gaze_timestamp, x_norm and y_norm columns of the kept rows as arrays
     """
-    data = []
-    indexes = [WORLD_FRAME_IDX, GAZE_TIMESTAMP, X_NORM, Y_NORM]  # Select the indexes to be saved
-    gaps = []  # Find gaps in data points
-    previous_time = 0.0
-
-    with open(csv_file_path) as csvfile:
-        datareader = reader(csvfile)
-        # Skip header
-        datareader.__next__()
-
-        for row in datareader:
-            # world_timestamp, world_frame_idx, gaze_timestamp, x_norm, y_norm, x_scaled, y_scaled, on_srf, confidence
-            if int(row[WORLD_FRAME_IDX]) >= start_frame:
-                data.append([row[i] for i in indexes])
-
-                if (float(row[GAZE_TIMESTAMP]) - previous_time) > cfg.GAZE_STAMP_THRESHOLD:
-                    # Gap detected, add timestamp to list
-                    gaps.append(float(row[GAZE_TIMESTAMP]))
-                previous_time = float(row[GAZE_TIMESTAMP])
-            else:
-                previous_time = float(row[GAZE_TIMESTAMP])
-
-    # Analyze gaps. Leave only significant gaps or gap clusters
-    final_gaps = []
-    cluster_start = 0
-    cluster_end = 0
-    gaps_in_cluster = 0
-    written = False
-
-    for gap in gaps:
-        if cluster_start == 0:
-            cluster_start = gap
-            cluster_end = gap
-            gaps_in_cluster += 1
-        else:
-            if (gap - cluster_end) < cfg.GAP_THRESHOLD:
-                cluster_end = gap
-                gaps_in_cluster += 1
-                written = False
-            else:
-                final_gaps.append([gaps_in_cluster, cluster_start, cluster_end])
-                written = True
-                cluster_start = gap
-                cluster_end = gap
-                gaps_in_cluster = 1
-
-    if not written:
-        final_gaps.append([gaps_in_cluster, cluster_start, cluster_end])
-
-    # Blink removal. Create new data structure by filtering out entries around found gaps
-    filtered_data = []
-    eliminated_data = []
-    next_gap = 0
-
-    for row in data:
-        if float(row[1]) > final_gaps[next_gap][2]:
-            # Passed current gap
-            if not next_gap == len(final_gaps) - 1:
-                next_gap += 1
-
-        # Ignore gap if gap time is too short, or the cluster is too small
-        if final_gaps[next_gap][2] - final_gaps[next_gap][1] < cfg.BLINK_REMOVE_THRESHOLD \
-                or final_gaps[next_gap][0] < cfg.MISSING_MEASUREMENT_THRESHOLD:
-            if (float(row[1]) > (final_gaps[next_gap][1] - cfg.BLINK_REMOVE_THRESHOLD)) \
-                    and (float(row[1]) < (final_gaps[next_gap][2] + cfg.BLINK_REMOVE_THRESHOLD)):
-                # Current items timestamp is inside elimination threshold
-                eliminated_data.append(row)
-            else:
-                filtered_data.append(row)
-        else:
-            filtered_data.append(row)
-
-    return filtered_data
+    columns = read_export_columns(csv_file_path, [WORLD_FRAME_IDX, GAZE_TIMESTAMP, X_NORM, Y_NORM],
+                                  [np.int64, np.float64, np.float64, np.float64])
+
+    mask = find_gap_mask(columns[0], columns[1], start_frame)
+
+    return [column[mask] for column in columns]
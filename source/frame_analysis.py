@@ -0,0 +1,141 @@
+import os
+
+import cv2
+import numpy as np
+
+import config as cfg
+from export_files import get_export_file
+from instrumentation import count, span
+from surface_positions import load_surface_positions
+
+
+class SurfaceFrame:
+    """
+    A decoded world video frame and the surface position on it.
+    Detectors read screen space pixels through screen_region() and screen_mean().
+    With sampling "roi" only the requested pixels are mapped back to the world frame,
+    with sampling "warp" the whole frame is warped once and shared by all detectors.
+    """
+
+    def __init__(self, index, image, surface, sampling=None):
+        self.index = index  # Zero based index of the decoded frame
+        self.surface_frame = int(surface["frame"])  # Frame index stored in the surface export
+        self.image = image
+        self.surface_matrix = surface["matrix"]
+        self.corners = surface["corners"]  # Surface corners in normalized world image coordinates
+        self.sampling = sampling if sampling is not None else cfg.FRAME_SAMPLING
+        self.height, self.width = image.shape[:2]
+        self._screen_transform = None
+        self._warp = None
+
+    def screen_transform(self):
+        """
+        Returns the perspective transform from world video pixels to screen pixels
+        """
+        if self._screen_transform is None:
+            self._screen_transform = self._get_screen_transform()
+        return self._screen_transform
+
+    def _get_screen_transform(self):
+        pts = np.zeros(shape=self.corners.shape, dtype=np.int32)
+        pts[:, 0] = self.corners[:, 0] * self.width
+        pts[:, 1] = self.height - self.corners[:, 1] * self.height
+
+        return cv2.getPerspectiveTransform(np.float32(pts),
+                                           np.float32([[0, 0], [self.width, 0],
+                                                       [self.width, self.height], [0, self.height]]))
+
+    def warp(self):
+        if self._warp is None:
+            self._warp = cv2.warpPerspective(self.image, self.screen_transform(),
+                                             dsize=(self.width, self.height))
+        return self._warp
+
+    def screen_region(self, x_lower, y_lower, x_upper, y_upper):
+        """
+        Returns the screen space pixels inside the given rectangle, clamped to the frame.
+        The result equals warp()[y_lower:y_upper, x_lower:x_upper] after clamping.
+        Returns None if nothing of the rectangle is inside the frame
+        """
+        x_lower, x_upper = max(x_lower, 0), min(x_upper, self.width)
+        y_lower, y_upper = max(y_lower, 0), min(y_upper, self.height)
+
+        # warpPerspective would fall back to the full frame size for an empty size
+        if x_upper <= x_lower or y_upper <= y_lower:
+            return None
+
+        if self.sampling == "warp":
+            return self.warp()[y_lower:y_upper, x_lower:x_upper]
+
+        # Shift the region to the origin so that only the region is warped
+        translation = np.array([[1, 0, -x_lower], [0, 1, -y_lower], [0, 0, 1]], dtype=np.float64)
+
+        return cv2.warpPerspective(self.image, translation @ self.screen_transform(),
+                                   dsize=(x_upper - x_lower, y_upper - y_lower))
+
+    def screen_mean(self):
+        """
+        Returns the average pixel value of the frame in screen space.
+        With sampling "roi" the average is taken over a sparse grid of screen pixels
+        """
+        if self.sampling == "warp":
+            return np.average(self.warp(), axis=(0, 1, 2))
+
+        step = cfg.SCREEN_MEAN_GRID_STEP
+        grid_x, grid_y = np.meshgrid(np.arange(step // 2, self.width, step, dtype=np.float64),
+                                     np.arange(step // 2, self.height, step, dtype=np.float64))
+
+        # Map the screen space grid back to world video pixels
+        points = np.stack((grid_x, grid_y, np.ones_like(grid_x)), axis=-1) @ np.linalg.inv(self.screen_transform()).T
+        map_x = np.float32(points[..., 0] / points[..., 2])
+        map_y = np.float32(points[..., 1] / points[..., 2])
+
+        samples = cv2.remap(self.image, map_x, map_y, interpolation=cv2.INTER_LINEAR,
+                            borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        return np.average(samples, axis=(0, 1, 2))
+
+
+def analyse_recording(location, recording, detectors, sampling=None):
+    """
+    Decode the world video of a recording once and feed every frame to the given detectors.
+    location is the base directory of the recording, not including the '000'
+    recording is the number of the recording
+    detectors is a list of objects with a 'done' attribute and 'update(frame)' and
+    'finish()' methods. update() is called with a SurfaceFrame for every frame until
+    the detector sets 'done', finish() is called once after the last frame.
+    sampling overrides cfg.FRAME_SAMPLING, use "warp" to check results against full frame warps
+    Returns the number of decoded frames.
+    """
+    video_file_path = os.path.join(location, recording, "world.mp4")
+    video = cv2.VideoCapture(video_file_path)
+
+    surfaces = load_surface_positions(get_export_file(location, recording, "srf_"))
+
+    frame_index = 0
+    active = [detector for detector in detectors if not detector.done]
+
+    # Stop decoding as soon as every detector has its result
+    while active and frame_index < len(surfaces):
+        with span("video_decode"):
+            if not video.grab():
+                break
+            image = video.retrieve()[1]
+        count("frames_decoded")
+
+        frame = SurfaceFrame(frame_index, image, surfaces[frame_index], sampling)
+
+        # Warping and sampling the screen happens in the detectors
+        with span("frame_analysis"):
+            for detector in active:
+                detector.update(frame)
+
+        active = [detector for detector in active if not detector.done]
+        frame_index += 1
+
+    video.release()
+
+    for detector in detectors:
+        detector.finish()
+
+    return frame_index
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import config as cfg
+
+# Columns of the per subject result files written by main.py
+RESULT_FRAME_INDEX = 0
+RESULT_X = 1
+RESULT_Y = 2
+
+
+class GazeResults:
+    """
+    The corrected gaze of every subject for one video as flat arrays sorted by frame.
+    frames, subjects, x and y hold one entry per gaze point, subjects are indexes to subject_names.
+    The points of frame i are the entries offsets[i]:offsets[i + 1]
+    """
+
+    def __init__(self, frames, subjects, x, y, subject_names):
+        order = np.lexsort((subjects, frames))
+        self.frames = np.asarray(frames, dtype=np.int64)[order]
+        self.subjects = np.asarray(subjects, dtype=np.int32)[order]
+        self.x = np.asarray(x, dtype=np.float64)[order]
+        self.y = np.asarray(y, dtype=np.float64)[order]
+        self.subject_names = list(subject_names)
+
+        n_frames = int(self.frames[-1]) + 1 if len(self.frames) else 0
+        self.offsets = np.searchsorted(self.frames, np.arange(n_frames + 1), "left")
+
+    def __len__(self):
+        # Number of frames
+        return len(self.offsets) - 1
+
+    def frame_slice(self, i):
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def points(self, i):
+        """
+        The gaze points of frame i rounded to pixels as an (N, 2) int array
+        """
+        index = self.frame_slice(i)
+        return np.column_stack((np.rint(self.x[index]), np.rint(self.y[index]))).astype(np.int64)
+
+    def frame_points(self, start=0, end=None):
+        """
+        Returns a list of the rounded gaze points of every frame from start to end
+        """
+        if end is None:
+            end = len(self)
+        return [self.points(i) for i in range(start, min(end, len(self)))]
+
+
+def get_result_files(video_dir):
+    """
+    Returns the result file of every subject in video_dir. If a subject has both a csv and an npz file,
+    the newer one is used
+    """
+    files = {}
+    for name in sorted(os.listdir(video_dir)):
+        subject, extension = os.path.splitext(name)
+        if extension in (".csv", ".npz"):
+            path = os.path.join(video_dir, name)
+            if subject not in files or os.path.getmtime(path) > os.path.getmtime(files[subject]):
+                files[subject] = path
+
+    return sorted(files.values())
+
+
+def read_result_file(result_file_path):
+    """
+    Read the frame indexes and gaze coordinates of one subject result file, csv or npz
+    """
+    if result_file_path.endswith(".npz"):
+        with np.load(result_file_path) as data:
+            return data["frame_index"].astype(np.int64), data["x_coord"], data["y_coord"]
+
+    data = np.loadtxt(result_file_path, delimiter=",", skiprows=1, ndmin=2)
+    if data.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+
+    return data[:, RESULT_FRAME_INDEX].astype(np.int64), data[:, RESULT_X], data[:, RESULT_Y]
+
+
+def get_results_cache_path(video_dir):
+    folder_hash = hashlib.sha1(os.path.abspath(video_dir).encode()).hexdigest()
+    return os.path.join(cfg.CACHE_DIRECTORY, "gaze_results_{}.npz".format(folder_hash))
+
+
+def load_gaze_results(video_dir, use_cache=False):
+    """
+    Load the results of every subject for one video.
+    video_dir is the folder of the video in the output directory of main.py, containing one file per subject.
+    use_cache stores the arrays in a binary file in cfg.CACHE_DIRECTORY that is used
+    as long as the result files have not changed
+    """
+    result_files = get_result_files(video_dir)
+    signature = json.dumps([(os.path.basename(x), os.path.getsize(x), os.path.getmtime(x)) for x in result_files])
+    subject_names = [os.path.splitext(os.path.basename(x))[0] for x in result_files]
+
+    cache_path = get_results_cache_path(video_dir)
+    if use_cache and os.path.isfile(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if str(cache["signature"]) == signature:
+                    return GazeResults(cache["frames"], cache["subjects"], cache["x"], cache["y"], subject_names)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    columns = [read_result_file(x) for x in result_files]
+    frames = np.concatenate([c[0] for c in columns] + [np.zeros(0, dtype=np.int64)])
+    subjects = np.concatenate([np.full(len(c[0]), i, dtype=np.int32) for i, c in enumerate(columns)] +
+                              [np.zeros(0, dtype=np.int32)])
+    x = np.concatenate([c[1] for c in columns] + [np.zeros(0)])
+    y = np.concatenate([c[2] for c in columns] + [np.zeros(0)])
+
+    results = GazeResults(frames, subjects, x, y, subject_names)
+
+    if use_cache:
+        try:
+            os.makedirs(cfg.CACHE_DIRECTORY, exist_ok=True)
+            # np.savez adds .npz to names without it
+            tmp_path = "{}.{}.tmp.npz".format(cache_path[:-4], os.getpid())
+            np.savez(tmp_path, frames=results.frames, subjects=results.subjects, x=results.x, y=results.y,
+                     signature=np.array(signature))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print("Could not write gaze result cache", cache_path, e)
+
+    return results
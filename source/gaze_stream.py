@@ -0,0 +1,414 @@
+import argparse
+import socket
+import sys
+import time
+from collections import deque
+from math import floor
+
+import numpy as np
+
+import config as cfg
+from export_files import read_export_columns
+from filter_gaps import WORLD_FRAME_IDX, GAZE_TIMESTAMP, X_NORM, Y_NORM
+
+# Gaze samples are (world frame index, gaze timestamp, x_norm, y_norm) tuples
+
+
+class GapCluster:
+    """
+    Consecutive gaps (missing measurements) less than GAP_THRESHOLD apart, see filter_gaps.find_gap_clusters
+    """
+
+    def __init__(self, timestamp, count=1):
+        self.count = count
+        self.start = timestamp
+        self.end = timestamp
+
+    def is_blink(self):
+        return self.end - self.start < cfg.BLINK_REMOVE_THRESHOLD or self.count < cfg.MISSING_MEASUREMENT_THRESHOLD
+
+    def removes(self, timestamp):
+        return self.is_blink() and \
+            self.start - cfg.BLINK_REMOVE_THRESHOLD < timestamp < self.end + cfg.BLINK_REMOVE_THRESHOLD
+
+
+class GapFilter:
+    """
+    Blink removal of filter_gaps for a stream of gaze samples.
+    Every sample waits until the gaps that decide whether it is kept have arrived, which is at most
+    BLINK_REMOVE_THRESHOLD + GAP_THRESHOLD after the end of the gap cluster it belongs to.
+    filter_gaps treats the end of the data specially: a lone gap at the very end is not a cluster, and the samples
+    after the last cluster are compared to it. Samples whose result depends on whether the stream ends
+    are held until the next gap arrives or the stream is flushed.
+    A sample is never held longer than max_delay seconds of gaze time, after that it is decided with
+    the gaps seen so far as if the stream continued. Only the samples and gap clusters inside that window
+    are kept in memory. The kept samples are the same as with filter_gaps unless some sample had to be
+    decided after max_delay
+    """
+
+    def __init__(self, start_frame=0, max_delay=None):
+        self.start_frame = start_frame
+        self.max_delay = cfg.STREAM_MAX_DELAY if max_delay is None else max_delay
+
+        # Like in find_gap_clusters the first sample is compared to zero
+        self.previous_time = 0.0
+        self.clusters = deque()  # Finished clusters that pending samples may still need, oldest first
+        self.open_cluster = None  # The cluster that the next gap could still extend
+        self.cluster_count = 0
+        self.pending = deque()
+
+    def push(self, frame, timestamp, x, y):
+        """
+        Add a sample. Returns the samples that are kept, in order, as soon as they are known
+        """
+        if frame >= self.start_frame:
+            if timestamp - self.previous_time > cfg.GAZE_STAMP_THRESHOLD:
+                self.add_gap(timestamp)
+            self.pending.append((frame, timestamp, x, y))
+        self.previous_time = timestamp
+
+        # A gap after this sample would be too far away to extend the open cluster
+        if self.open_cluster is not None and timestamp - self.open_cluster.end >= cfg.GAP_THRESHOLD:
+            self.clusters.append(self.open_cluster)
+            self.open_cluster = None
+
+        return self.release(False)
+
+    def flush(self):
+        """
+        End of the stream. Returns the remaining kept samples
+        """
+        return self.release(True)
+
+    def add_gap(self, timestamp):
+        if self.open_cluster is not None and timestamp - self.open_cluster.end < cfg.GAP_THRESHOLD:
+            self.open_cluster.count += 1
+            self.open_cluster.end = timestamp
+            return
+
+        if self.open_cluster is not None:
+            self.clusters.append(self.open_cluster)
+        self.open_cluster = GapCluster(timestamp)
+        self.cluster_count += 1
+
+    def find_cluster(self, timestamp):
+        # The first cluster that has not ended before the sample
+        for cluster in self.clusters:
+            if cluster.end >= timestamp:
+                return cluster
+        if self.open_cluster is not None and self.open_cluster.end >= timestamp:
+            return self.open_cluster
+
+        return None
+
+    def find_final_cluster(self, timestamp):
+        """
+        The cluster that filter_gaps would compare the sample to if the stream ended now
+        """
+        clusters = list(self.clusters)
+        if self.open_cluster is not None:
+            clusters.append(self.open_cluster)
+
+        # A lone gap that starts a new cluster at the very end of the data is not counted as a cluster
+        if self.cluster_count > 1 and clusters[-1].count == 1:
+            clusters.pop()
+
+        for cluster in clusters:
+            if cluster.end >= timestamp:
+                return cluster
+
+        # Samples after the last cluster are compared to the last cluster
+        if clusters:
+            return clusters[-1]
+        return GapCluster(0.0, 0) if self.cluster_count == 0 else None
+
+    def is_kept_if_continued(self, timestamp, forced):
+        """
+        Whether the sample is kept when more gaps follow, or None when that is not known yet.
+        forced decides with the gaps seen so far
+        """
+        cluster = self.find_cluster(timestamp)
+
+        if cluster is None:
+            # The next cluster has to start more than BLINK_REMOVE_THRESHOLD after the sample to not remove it
+            if forced or (self.open_cluster is None and
+                          self.previous_time >= timestamp + cfg.BLINK_REMOVE_THRESHOLD):
+                return True
+            return None
+
+        # Growing the open cluster can only make it stop being a blink
+        if cluster is self.open_cluster and not forced and cluster.is_blink() and \
+                cluster.start - cfg.BLINK_REMOVE_THRESHOLD < timestamp:
+            return None
+
+        return not cluster.removes(timestamp)
+
+    def is_kept(self, timestamp, final):
+        """
+        Returns whether the sample at timestamp is kept or None when that is not known yet.
+        A sample is decided when the result is the same whether the stream ends now or more gaps follow
+        """
+        final_cluster = self.find_final_cluster(timestamp)
+        kept_at_end = final_cluster is None or not final_cluster.removes(timestamp)
+        if final:
+            return kept_at_end
+
+        if self.previous_time - timestamp > self.max_delay:
+            return self.is_kept_if_continued(timestamp, True)
+
+        kept = self.is_kept_if_continued(timestamp, False)
+        if kept is None or kept != kept_at_end:
+            return None
+        return kept
+
+    def release(self, final):
+        released = []
+        while self.pending:
+            kept = self.is_kept(self.pending[0][1], final)
+            if kept is None:
+                break
+            sample = self.pending.popleft()
+            if kept:
+                released.append(sample)
+
+        # Keep the last two clusters for find_final_cluster(), older ones are not needed once the samples
+        # have passed them
+        oldest = self.pending[0][1] if self.pending else self.previous_time
+        while len(self.clusters) > 2 and self.clusters[0].end < oldest:
+            self.clusters.popleft()
+
+        return released
+
+
+class FrameBinner:
+    """
+    Averages the samples of every video frame like gaze_to_frame. The frame of a sample is based on the time
+    since start_time, the timestamp of the first sample of the video. A frame is finished when a sample
+    of a later frame arrives. Frames with fewer samples than the blink threshold of gaze_to_frame are left out
+    """
+
+    def __init__(self, framerate, start_time):
+        self.frametime = 1. / framerate
+        self.threshold = int(floor(240. / framerate - 0.01))
+        self.start_time = start_time
+
+        self.frame = None
+        self.sum_x = 0.
+        self.sum_y = 0.
+        self.count = 0
+
+    def get_frame(self, timestamp):
+        return int(floor((timestamp - self.start_time) / self.frametime))
+
+    def push(self, timestamp, x, y):
+        """
+        Add a sample. Returns the finished frame as (frame index, mean x, mean y) or None
+        """
+        frame = self.get_frame(timestamp)
+        finished = None
+        if frame != self.frame:
+            finished = self.finish()
+            self.frame = frame
+
+        self.sum_x += x
+        self.sum_y += y
+        self.count += 1
+
+        return finished
+
+    def flush(self, last_timestamp):
+        """
+        End of the stream. The frame of the last sample, last_timestamp, is incomplete and left out
+        """
+        if self.frame is not None and self.frame < self.get_frame(last_timestamp):
+            return self.finish()
+        return None
+
+    def finish(self):
+        finished = None
+        if self.frame is not None and self.count >= self.threshold:
+            finished = (self.frame, self.sum_x / self.count, self.sum_y / self.count)
+
+        self.sum_x = 0.
+        self.sum_y = 0.
+        self.count = 0
+        return finished
+
+
+class GazeStream:
+    """
+    Corrected gaze for a video from a live stream of gaze samples.
+    push() takes one sample and returns the frames finished by it as (frame index, x, y) in video pixels,
+    the same values that gaze_to_frame gives for the frame. Frames without valid gaze are not returned.
+    correction is a GazeCorrection, eg. from get_correction_func_dispenser, and can be replaced
+    with set_correction() during the stream, eg. after a new calibration
+    """
+
+    def __init__(self, framerate, resolution, correction=None, start_frame=0, max_delay=None):
+        self.framerate = framerate
+        self.resolution = resolution
+        self.correction = correction
+        self.start_frame = start_frame
+
+        self.gap_filter = GapFilter(start_frame, max_delay)
+        self.binner = None
+        self.last_time = None
+
+    def set_correction(self, correction):
+        self.correction = correction
+
+    def push(self, frame, timestamp, x, y):
+        if frame >= self.start_frame:
+            if self.binner is None:
+                self.binner = FrameBinner(self.framerate, timestamp)
+            self.last_time = timestamp
+
+        return self.bin_samples(self.gap_filter.push(frame, timestamp, x, y))
+
+    def flush(self):
+        """
+        End of the stream. Returns the remaining frames
+        """
+        frames = self.bin_samples(self.gap_filter.flush())
+        if self.binner is not None:
+            frames += self.to_pixels([self.binner.flush(self.last_time)])
+        return frames
+
+    def bin_samples(self, samples):
+        return self.to_pixels([self.binner.push(timestamp, x, y) for _, timestamp, x, y in samples])
+
+    def to_pixels(self, finished):
+        # gaze_to_frame loads OpenCV, which publishing samples does not need
+        from gaze_to_frame import correct_points
+
+        frames = []
+        for item in finished:
+            if item is None:
+                continue
+            point = correct_points(np.array([item[1:]]), self.correction)[0]
+            x = self.resolution[0] * point[0]
+            y = self.resolution[1] - self.resolution[1] * point[1]
+            if 0 <= x <= self.resolution[0] and 0 <= y <= self.resolution[1]:
+                frames.append((item[0], x, y))
+        return frames
+
+    def process(self, samples):
+        """
+        Run the whole stream of samples through, yielding the finished frames as they become available
+        """
+        for sample in samples:
+            yield from self.push(*sample)
+        yield from self.flush()
+
+
+def read_export_samples(gaze_file_path):
+    """
+    The samples of a Pupil gaze export, to replay a finished recording as a stream
+    """
+    frames, timestamps, x_norm, y_norm = read_export_columns(gaze_file_path,
+                                                            [WORLD_FRAME_IDX, GAZE_TIMESTAMP, X_NORM, Y_NORM],
+                                                            [np.int64, np.float64, np.float64, np.float64])
+    return zip(frames.tolist(), timestamps.tolist(), x_norm.tolist(), y_norm.tolist())
+
+
+def parse_sample(line):
+    frame, timestamp, x, y = line.split(",")
+    return int(frame), float(timestamp), float(x), float(y)
+
+
+def read_socket_samples(host, port):
+    """
+    Samples from a publisher on a local TCP socket, one "frame,timestamp,x,y" line per sample.
+    Stands in for the network API of Pupil Capture
+    """
+    with socket.create_connection((host, port)) as connection:
+        with connection.makefile("r") as lines:
+            for line in lines:
+                if line.strip():
+                    yield parse_sample(line)
+
+
+def publish_samples(samples, host, port, speed=1.):
+    """
+    Serve the samples to one client of read_socket_samples. With speed > 0 the samples are sent
+    at speed times the rate of their timestamps, speed 0 sends them as fast as possible
+    """
+    with socket.create_server((host, port)) as server:
+        connection, _ = server.accept()
+        with connection, connection.makefile("w") as out:
+            start = None
+            for frame, timestamp, x, y in samples:
+                if speed > 0:
+                    if start is None:
+                        start = (time.perf_counter(), timestamp)
+                    delay = (timestamp - start[1]) / speed - (time.perf_counter() - start[0])
+                    if delay > 0:
+                        out.flush()
+                        time.sleep(delay)
+                out.write("{},{!r},{!r},{!r}\n".format(frame, timestamp, x, y))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Correct a live stream of gaze samples. "
+                                                 "Prints frame_index,x_coord,y_coord lines like the result files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    publish = commands.add_parser("publish", help="Replay a Pupil gaze export on a local socket")
+    publish.add_argument("gaze_file", help="gaze_positions_on_surface csv file")
+    publish.add_argument("--speed", type=float, default=1., help="Replay speed, 0 sends as fast as possible")
+
+    correct = commands.add_parser("correct", help="Correct the samples from a publisher or a gaze export")
+    correct.add_argument("--gaze-file", default=None, help="Read the samples from this gaze export "
+                                                           "instead of the socket")
+    correct.add_argument("--framerate", type=float, default=60, help="Framerate of the video")
+    correct.add_argument("--resolution", default="1920x1080", help="Resolution of the video as WIDTHxHEIGHT")
+    correct.add_argument("--start-frame", type=int, default=0, help="First world frame of the video")
+    correct.add_argument("--subject", default=None, help="Subject folder for the gaze correction")
+    correct.add_argument("--corrections", default=None, help="Correction table saved by main.py to use "
+                                                             "instead of fitting the correction of the subject")
+    correct.add_argument("--video", default=None, help="Video name for the gaze correction, "
+                                                       "required with --subject and --corrections")
+
+    for command in (publish, correct):
+        command.add_argument("--host", default="127.0.0.1")
+        command.add_argument("--port", type=int, default=50021)
+
+    args = parser.parse_args()
+    # Without the video name the correction would silently be the default one
+    if args.command == "correct" and args.video is None and \
+            (args.subject is not None or args.corrections is not None):
+        correct.error("--video is required with --subject and --corrections")
+
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "publish":
+        publish_samples(read_export_samples(args.gaze_file), args.host, args.port, args.speed)
+        return
+
+    # The correction needs OpenCV and scikit-learn, which publishing does not
+    from get_correction_func import get_correction_func_dispenser, load_correction_table
+
+    correction = None
+    if args.corrections is not None:
+        correction = load_correction_table(args.corrections)[args.video]
+    elif args.subject is not None:
+        correction = get_correction_func_dispenser(args.subject)(args.video)
+
+    if args.gaze_file is not None:
+        samples = read_export_samples(args.gaze_file)
+    else:
+        samples = read_socket_samples(args.host, args.port)
+
+    stream = GazeStream(args.framerate, [int(x) for x in args.resolution.split("x")], correction, args.start_frame)
+    print("frame_index,x_coord,y_coord")
+    for frame, x, y in stream.process(samples):
+        print("{},{},{}".format(frame, x, y))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,51 @@
 import os
 from math import floor
 
-from csv import reader
+import numpy as np
+
+from compress_gaze_points import group_by_frame
+from export_files import get_export_file, read_export_columns
+from filter_gaps import WORLD_FRAME_IDX, GAZE_TIMESTAMP, X_NORM, Y_NORM
 from get_starting_frame import get_starting_frame
+from instrumentation import span
 
 
-def average_gaze(data):
-    x = 0
-    y = 0
-    for item in data:
-        x += item[0]
-        y += item[1]
+def in_frame(points, topright):
+    """
+    Returns a boolean mask of the (N, 2) points that are inside the frame
+    """
+    return (points[:, 0] >= 0) & (points[:, 1] >= 0) & (points[:, 0] <= topright[0]) & (points[:, 1] <= topright[1])
 
-    return x / len(data), y / len(data),
 
+def correct_points(points, correction_function):
+    """
+    Apply the correction to an (N, 2) array of points. GazeCorrection objects correct
+    all points at once, other functions are called point by point
+    """
+    if correction_function is None:
+        return points
+    if hasattr(correction_function, "apply"):
+        return correction_function.apply(points)
 
-def in_frame(point, topright):
-    if point[0] < 0 or point[1] < 0:
-        return False
-    if point[0] > topright[0] or point[1] > topright[1]:
-        return False
-    return True
+    return np.array([correction_function(x, y) for x, y in points], dtype=np.float64).reshape(-1, 2)
 
 
-def gaze_to_frame(location, recording, framerate=60, correction_function=lambda x, y: (x, y)):
+@span("gaze_to_frame")
+def gaze_to_frame(location, recording, framerate=60, correction_function=None):
     """
     location is the path to the video about the recording not including the number "000"
     recording is the number
     framerate is the framerate of the video that the recording is about
-    correction_function should be a function that takes x and y coordinate and returns a tuple containing
-    the corrected x and y coordinate
-    Returns an array containing the gaze for each frame, might be missing some (<10) frames at the end
+    correction_function should be a GazeCorrection or a function that takes x and y coordinate
+    and returns a tuple containing the corrected x and y coordinate. None leaves the gaze uncorrected
+    Returns an (n_frames, 2) float32 array containing the gaze for each frame in video pixels.
+    Frames without valid gaze are NaN. Might be missing some (<10) frames at the end
     """
     start_frame = get_starting_frame(location, recording, threshold=22.)
 
-    gaze_file_path = os.path.join(location, recording, "exports")
-    assert (len(os.listdir(gaze_file_path)) == 1)  # Make sure there is exactly one export result
-
-    gaze_file_path = os.path.join(gaze_file_path, os.listdir(gaze_file_path)[0], "surfaces")
-    for item in os.listdir(gaze_file_path):
-        if item[0:4] == "gaze":
-            gaze_file_path = os.path.join(gaze_file_path, item)
-            break
+    gaze_file_path = get_export_file(location, recording, "gaze")
 
-    assert (gaze_file_path[-4:] == ".csv")  # Make sure gaze file was actually found
+    assert (gaze_file_path is not None and gaze_file_path[-4:] == ".csv")  # Make sure gaze file was actually found
 
     if os.path.basename(os.path.normpath(location)) == "calibrations":
         resolution = [3840, 2160]
@@ -56,38 +58,36 @@ def gaze_to_frame(location, recording, framerate=60, correction_function=lambda
     # removed in succession meaning that the watcher blinked
     threshold = int(floor(240. / framerate - 0.01))
 
-    final_data = []
-
-    with open(gaze_file_path) as gaze_file:
-        gaze_reader = reader(gaze_file)
-        gaze_reader.__next__()  # skip the header row
-        data = gaze_reader.__next__()
-
-        # Skip the black frames
-        while int(data[1]) < start_frame:
-            data = gaze_reader.__next__()
-
-        initial_timestamp = float(data[2])  # used for determining to which frame the gaze should be tied
-        data_points = []
-
-        for row in gaze_reader:
-            if initial_timestamp + frametime < float(row[2]):
-                if len(data_points) < threshold:
-                    final_data.append(None)
-                else:
-                    temp = average_gaze(data_points)
-                    x, y = correction_function(temp[0], temp[1])
-                    x = resolution[0] * x
-                    y = resolution[1] - resolution[1] * y
-
-                    if in_frame((x, y), resolution):
-                        final_data.append((x, y,))
-                    else:
-                        final_data.append(None)
-                data_points = []
-                initial_timestamp += frametime
-
-            data_points.append((float(row[3]), float(row[4]),))
+    frames, timestamps, x_norm, y_norm = read_export_columns(gaze_file_path,
+                                                            [WORLD_FRAME_IDX, GAZE_TIMESTAMP, X_NORM, Y_NORM],
+                                                            [np.int64, np.float64, np.float64, np.float64])
+
+    # Skip the black frames
+    if not np.any(frames >= start_frame):
+        return np.zeros((0, 2), dtype=np.float32)
+    first = int(np.argmax(frames >= start_frame))
+    timestamps = timestamps[first:]
+
+    # Tie every gaze point to a video frame based on the time since the first point
+    frame_index = np.floor((timestamps - timestamps[0]) / frametime).astype(np.int64)
+
+    # The frame of the last gaze point is incomplete and left out
+    n_frames = int(frame_index[-1])
+    used = frame_index < n_frames
+
+    bins, avg_x, avg_y, counts = group_by_frame(frame_index[used], x_norm[first:][used], y_norm[first:][used])
+
+    # Frames with too few gaze points are considered blinks
+    valid = counts >= threshold
+    bins = bins[valid]
+
+    points = correct_points(np.column_stack((avg_x[valid], avg_y[valid])), correction_function)
+    points = np.column_stack((resolution[0] * points[:, 0], resolution[1] - resolution[1] * points[:, 1]))
+
+    inside = in_frame(points, resolution)
+
+    final_data = np.full((n_frames, 2), np.nan, dtype=np.float32)
+    final_data[bins[inside]] = points[inside]
 
     return final_data
 
@@ -6,59 +6,138 @@ from sklearn.cluster import KMeans
 from sklearn import metrics
 
 import config as cfg
+from calibration_cache import cached, get_recording_files, ERROR_CONFIG, AVERAGE_CONFIG
 from get_calibration_error import get_calibration_error
 from get_video_order import get_video_order
+from instrumentation import count, span
+from video_metadata import get_video_metadata
+
+
+class GazeCorrection:
+    """
+    Perspective correction of gaze points for a single video.
+    matrix is the 3x3 perspective transform applied to normalized gaze coordinates.
+    Calling the object with x and y corrects a single point, apply() corrects many points at once
+    """
+
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+    def apply(self, points):
+        """
+        Correct an (N, 2) array of points in a single call. Returns an (N, 2) float64 array
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        if len(points) == 0:
+            return np.zeros((0, 2), dtype=np.float64)
+
+        return cv2.perspectiveTransform(points, self.matrix).reshape(-1, 2)
+
+    def __call__(self, x, y):
+        tmp = np.float32([[[x, y]]])
+        corr_tmp = cv2.perspectiveTransform(tmp, self.matrix)
+        return corr_tmp[0, 0]
 
 
 def choose_cluster(data, labels, n_clusters):
-    # Choose best cluster based on cluster size
-    clusters = {}
+    # Choose best cluster based on cluster size. Ties go to the lowest label
+    best_cluster = np.argmax(np.bincount(labels, minlength=n_clusters))
+
+    return data[labels == best_cluster]
+
+
+def simplified_silhouette_score(distances, labels):
+    """
+    Silhouette score computed from the distances to the cluster centers instead of
+    all pairwise distances. distances is the (n_samples, n_clusters) output of KMeans.transform()
+    """
+    own = distances[np.arange(len(labels)), labels]
+    other = distances.copy()
+    other[np.arange(len(labels)), labels] = np.inf
+    nearest = other.min(axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scores = (nearest - own) / np.maximum(own, nearest)
 
-    best_score = 0
-    best_cluster = 0
+    return np.average(np.nan_to_num(scores))
 
-    for cluster in range(n_clusters):
-        clusters[cluster] = np.array([x[0] for x in zip(data, labels) if x[1] == cluster])
 
-        if best_score < len(clusters[cluster]):
-            best_score = len(clusters[cluster])
-            best_cluster = cluster
+def fit_clusters_fast(data):
+    """
+    Fit KMeans for every cluster count between 2 and cfg.MAX_CLUSTERS. Each fit starts from the centers
+    of the previous one plus the point farthest from them, and is scored with the simplified silhouette.
+    Returns a dictionary { n_clusters: (labels, score) }
+    """
+    fits = {}
+
+    # Start from the two points farthest apart along the first principal axis
+    centered = data - np.average(data, axis=0)
+    projection = centered @ np.linalg.svd(centered, full_matrices=False)[2][0]
+    centers = data[[np.argmin(projection), np.argmax(projection)]]
 
-    return clusters[best_cluster]
+    for n_clusters in range(2, cfg.MAX_CLUSTERS + 1):
+        if n_clusters > 2:
+            # Add the point farthest from the existing centers as a new center
+            distances = np.min(np.linalg.norm(data[:, None] - centers[None], axis=2), axis=1)
+            centers = np.vstack((centers, data[np.argmax(distances)]))
 
+        cluster_func = KMeans(n_clusters=n_clusters, init=centers, n_init=1, random_state=1)
+        count("kmeans_fits")
+        labels = cluster_func.fit_predict(data)
+        centers = cluster_func.cluster_centers_
 
-def cluster_analysis(data):
+        fits[n_clusters] = (labels, simplified_silhouette_score(cluster_func.transform(data), labels))
+
+    return fits
+
+
+def fit_clusters_exact(data):
+    """
+    Fit KMeans for every cluster count between 2 and cfg.MAX_CLUSTERS and score with the silhouette method.
+    Returns a dictionary { n_clusters: (labels, score) }
+    """
+    fits = {}
+    for n_clusters in range(2, cfg.MAX_CLUSTERS + 1):
+        # Initialize clustering with n clusters and a random state for consistent results
+        cluster_func = KMeans(n_clusters=n_clusters, random_state=1)
+        count("kmeans_fits")
+        labels = cluster_func.fit_predict(data)
+
+        # The average silhouette score for n clusters
+        fits[n_clusters] = (labels, metrics.silhouette_score(data, labels))
+
+    return fits
+
+
+@span("cluster_analysis")
+def cluster_analysis(data, mode=None):
     # Cluster gaze points if they are dispersed.
     # Return best cluster, other clusters are pruned out
+    # mode is "exact" or "fast", cfg.CLUSTER_MODE by default
+    if mode is None:
+        mode = cfg.CLUSTER_MODE
+
     avg = np.average(data, axis=0)
 
     x_low = avg[0] - cfg.CLUSTER_THRESHOLD_WIDTH / 2
     x_high = avg[0] + cfg.CLUSTER_THRESHOLD_WIDTH / 2
     y_low = avg[1] - cfg.CLUSTER_THRESHOLD_HEIGHT / 2
     y_high = avg[1] + cfg.CLUSTER_THRESHOLD_HEIGHT / 2
-    in_threshold = 0
+
     # Check percentage of gaze points within threshold
-    for i in data:
-        if not (i[0] < x_low or i[0] > x_high or i[1] < y_low or i[1] > y_high):
-            in_threshold += 1
+    in_threshold = np.count_nonzero((data[:, 0] >= x_low) & (data[:, 0] <= x_high) &
+                                    (data[:, 1] >= y_low) & (data[:, 1] <= y_high))
 
     if in_threshold / len(data) < cfg.CLUSTER_PERCENTAGE_THRESHOLD:
         # Perform clustering
         # Decide optimal number of clusters with silhouette method. Try with cluster num between 2 to max clusters
-        tmp = {}  # Store clustering scores here
-        c_labels = {}
-        for n_clusters in range(2, cfg.MAX_CLUSTERS + 1):
-            # Initialize clustering with n clusters and a random state for consistent results
-            cluster_func = KMeans(n_clusters=n_clusters, random_state=1)
-            c_labels[n_clusters] = cluster_func.fit_predict(data)
-
-            # The average silhouette score for n clusters
-            silhouette_avg = metrics.silhouette_score(data, c_labels[n_clusters])
-
-            tmp[n_clusters] = silhouette_avg
+        if mode == "fast":
+            fits = fit_clusters_fast(data)
+        else:
+            fits = fit_clusters_exact(data)
 
-        optimal_n = max(tmp.items(), key=lambda x: x[1])
-        output = choose_cluster(data, c_labels[optimal_n[0]], optimal_n[0])
+        optimal_n = max(fits.items(), key=lambda x: x[1][1])[0]
+        output = choose_cluster(data, fits[optimal_n][0], optimal_n)
 
     else:
         output = data
@@ -66,27 +145,56 @@ def cluster_analysis(data):
     return output
 
 
-def get_cp_averages(subject):
+def get_error_points(values):
+    """
+    Returns the gaze error of one calibration point as an (N, 2) array without the outliers.
+    values is an entry of the gaze error returned by get_calibration_error
+    """
+    return np.column_stack((values[0], values[1]))[~values[3]]
+
+
+def cluster_mode_report(subject, use_cache=True):
+    """
+    Compare the chosen cluster means of the fast and the exact clustering mode for every
+    calibration point of a subject. Returns a list of
+    (calibration, calibration point, exact mean, fast mean, distance between the means)
+    """
     calibrations_path = os.path.join(subject, "calibrations")
+    report = []
+    for calibration in get_calibration_folders(subject):
+        gaze_error, _ = cached(
+            "error", get_recording_files(calibrations_path, calibration), ERROR_CONFIG,
+            lambda: get_calibration_error(calibrations_path, calibration, use_cache=use_cache),
+            use_cache=use_cache)
 
-    average_dict = {}
+        for cp, values in gaze_error.items():
+            data = get_error_points(values)
+            if len(data) == 0:
+                continue
+            exact = np.average(cluster_analysis(data, "exact"), axis=0)
+            fast = np.average(cluster_analysis(data, "fast"), axis=0)
+            report.append((calibration, cp, exact, fast, float(np.linalg.norm(exact - fast))))
 
-    # Get calibration directories
+    return report
 
-    # Check if directory contains calibrations
-    if os.path.isdir(calibrations_path):
-        calibrations = next(os.walk(calibrations_path))[1]
-    else:
-        calibrations = []
 
-    # Iterate through last eight entries. First 1-3 folders can be initial calibrations
-    for calibration in calibrations[-8:]:
-        avg_tmp = {}
+def get_calibration_averages(subject, calibration, use_cache=True):
+    """
+    Calculate the average gaze error of each calibration point in one calibration.
+    Intervals, errors and averages are read from the calibration cache when the inputs are unchanged
+    """
+    calibrations_path = os.path.join(subject, "calibrations")
+    files = get_recording_files(calibrations_path, calibration)
+
+    def compute_averages():
         # Gaze error will be in format:
         # { calibration_point: [ error_x[], error_y[], error_combined[], outlier_indices[] ] }
         # Fixation error will be in format:
         # { calibration_point: [ start frame, end frame, error x, error y, cp start frame, cp end frame ] }
-        gaze_error, fixation_error = get_calibration_error(calibrations_path, calibration)
+        gaze_error, fixation_error = cached(
+            "error", files, ERROR_CONFIG,
+            lambda: get_calibration_error(calibrations_path, calibration, use_cache=use_cache),
+            use_cache=use_cache)
 
         # Fixation error won't be used
 
@@ -95,13 +203,10 @@ def get_cp_averages(subject):
         for cp, values in gaze_error.items():
             print("Processing: ", os.path.basename(os.path.normpath(subject)), calibration, cp)
 
-            x = [x for index, x in enumerate(values[0]) if index not in values[3]]
-            y = [y for index, y in enumerate(values[1]) if index not in values[3]]
-
             # Cluster analysis
             # Perform clustering if gaze points are dispersed.
             # After clustering, select the best cluster for subsequent processing
-            tmp_data = np.column_stack((x, y))
+            tmp_data = get_error_points(values)
             if len(tmp_data) > 0:
                 clustered_data = cluster_analysis(tmp_data)
 
@@ -112,31 +217,19 @@ def get_cp_averages(subject):
             else:
                 gaze_tmp[cp] = []
 
-        avg_tmp['gaze_error'] = gaze_tmp
-
-        average_dict[calibration] = avg_tmp
-
-    return average_dict
-
+        return {'gaze_error': gaze_tmp}
 
-def get_frame_count(video):
-    video_file_path = os.path.join(cfg.TEST_VIDEO_FOLDER, video)
-    handle = cv2.VideoCapture(video_file_path)
-    count = int(handle.get(cv2.CAP_PROP_FRAME_COUNT))
+    return cached("averages", files, AVERAGE_CONFIG, compute_averages, use_cache=use_cache)
 
-    return count
 
+def get_cp_averages(subject, use_cache=True):
+    average_dict = {}
 
-def get_fps(video):
-    # FPS is included in every video name. Split and retrieve
-    # Format: name_resolution_fps.
-    substr = video.split('_')
-    if len(substr[2]) > 2:
-        fps = int(substr[2][:2])
-    else:
-        fps = int(substr[2])
+    # Iterate through last eight entries. First 1-3 folders can be initial calibrations
+    for calibration in get_calibration_folders(subject):
+        average_dict[calibration] = get_calibration_averages(subject, calibration, use_cache)
 
-    return fps
+    return average_dict
 
 
 def get_calibration_folders(subject):
@@ -171,152 +264,182 @@ def get_timeline(subject):
             calibration += 1
             insert_calibration = 0
         else:
+            # Frame count and fps come from the shared test video index,
+            # including the corrections in cfg.VIDEO_METADATA_OVERRIDES
+            metadata = get_video_metadata(order[i])
             tmp['name'] = order[i]
-            tmp['frame_count'] = get_frame_count(order[i])
-            tmp['fps'] = get_fps(order[i])
+            tmp['frame_count'] = metadata['frame_count']
+            tmp['fps'] = metadata['fps']
             tmp['length'] = tmp['frame_count'] / tmp['fps']
             insert_calibration += 1
 
         timeline.append(tmp)
 
-    # Purkkafix9000
-    # One video has wrong fps in it's filename. Fix here
-    for item in timeline:
-        if item['name'] == "oldTownCross_1920x1080_60.y4m":
-            item['fps'] = 50
-            item['length'] = item['frame_count'] / item['fps']
-            break
-
-    for item in timeline:
-        if item['name'] == "rushHour_1920x1080_50.y4m":
-            item['fps'] = 25
-            item['length'] = item['frame_count'] / item['fps']
-            break
-
     return timeline
 
 
-def order_by_cp(average_data):
+class Timeline:
     """
-    Group average data by calibration point. Previously, data is grouped by calibration video
+    Start and end times of the timeline items of get_timeline as arrays.
+    The times are in seconds from the start of the first video, index maps an item name to its first position
     """
-    cp_x = []
-    cp_y = []
 
-    # Initialize empty lists for re-arranging average values
-    # Ex. the center calibration point errors are all stored in the same list index
-    for i in range(5):
-        cp_x.append([])
-        cp_y.append([])
+    def __init__(self, items):
+        self.names = [item['name'] for item in items]
+        self.ends = np.cumsum([float(item['length']) for item in items])
+        self.starts = np.concatenate(([0.], self.ends[:-1]))
+        self.total = float(self.ends[-1]) if len(items) else 0.
 
-    for calibration, values in average_data.items():
-        for i in range(5):
-            cp_x[i].append(values['gaze_error'][cfg.CALIBRATION_POINT_NAMES[i]][0])
-            cp_y[i].append(values['gaze_error'][cfg.CALIBRATION_POINT_NAMES[i]][1])
+        self.index = {}
+        for i, name in enumerate(self.names):
+            self.index.setdefault(name, i)
 
-    output = {}
-    for i in range(5):
-        output[cfg.CALIBRATION_POINT_NAMES[i]] = [cp_x[i], cp_y[i]]
+    # Names that are not in the timeline start and end at the end of the timeline
+    def start_time(self, name):
+        return float(self.starts[self.index[name]]) if name in self.index else self.total
 
-    return output
+    def end_time(self, name):
+        return float(self.ends[self.index[name]]) if name in self.index else self.total
 
 
-def get_video_start_time(timeline, video):
-    time = 0
-    for item in timeline:
-        if item['name'] == video:
-            break
-        time += item['length']
+def fit_corner_drift(times, average_data):
+    """
+    Fit a line to the gaze error of every corner calibration point over time with one least squares solve.
+    times are the start times of the calibrations in average_data
+    Returns the slopes and intercepts as (4, 2) arrays of x and y errors
+    """
+    errors = np.array([[values['gaze_error'][cfg.CALIBRATION_POINT_NAMES[i]][:2] for i in range(1, 5)]
+                       for values in average_data.values()], dtype=np.float64).reshape(len(times), 8)
 
-    return time
+    # Scale the columns like np.polyfit does to keep the solve well conditioned
+    lhs = np.column_stack((times, np.ones(len(times))))
+    scale = np.sqrt((lhs * lhs).sum(axis=0))
+    coefficients = np.linalg.lstsq(lhs / scale, errors, rcond=None)[0] / scale[:, np.newaxis]
 
+    return coefficients[0].reshape(4, 2), coefficients[1].reshape(4, 2)
 
-def get_video_end_time(timeline, video):
-    time = 0
-    found = False
-    for item in timeline:
-        if item['name'] == video:
-            found = True
-        time += item['length']
-        if found:
-            break
 
-    return time
+def get_perspective_transforms(source, destination):
+    """
+    cv2.getPerspectiveTransform for many quadrangles at once.
+    source and destination are (V, 4, 2) arrays, returns the (V, 3, 3) transforms
+    """
+    # Same linear system as OpenCV, which takes float32 points: the first 4 rows map to u, the last 4 rows to v
+    source = np.asarray(source, dtype=np.float32)
+    destination = np.asarray(destination, dtype=np.float32)
+    x, y = source[..., 0], source[..., 1]
+    u, v = destination[..., 0], destination[..., 1]
+    zeros = np.zeros_like(x)
+    ones = np.ones_like(x)
 
+    a = np.concatenate((np.stack((x, y, ones, zeros, zeros, zeros, -x * u, -y * u), axis=-1),
+                        np.stack((zeros, zeros, zeros, x, y, ones, -x * v, -y * v), axis=-1)), axis=1)
+    b = np.concatenate((u, v), axis=1)
+    solution = np.linalg.solve(a.astype(np.float64), b[..., np.newaxis].astype(np.float64))[..., 0]
 
-def get_correction_func_dispenser(subject):
+    return np.concatenate((solution, np.ones((len(solution), 1))), axis=1).reshape(-1, 3, 3)
+
+
+class CorrectionTable:
     """
-    Get the gaze point correction function for given subject.
-    
-    subject is the root folder which contains the video data for said subject 
+    The correction matrices of every timeline item of a subject as one (V, 3, 3) array.
+    names are the item names of the rows, default is the matrix for names that are not in the timeline.
+    table[video] gives the GazeCorrection of a video
     """
 
-    average_gaze_data = get_cp_averages(subject)
-    cp_ordered_data = order_by_cp(average_gaze_data)
-    timeline = get_timeline(subject)
-    calibrations = get_calibration_folders(subject)
+    def __init__(self, names, matrices, default):
+        self.names = list(names)
+        self.matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 3, 3)
+        self.default = np.asarray(default, dtype=np.float64)
 
-    # Get x axis values for line fitting
-    x_tmp = []
-    for i in range(len(calibrations)):
-        x_tmp.append(get_video_start_time(timeline, calibrations[i]))
+        self.index = {}
+        for i, name in enumerate(self.names):
+            self.index.setdefault(name, i)
 
-    x = np.array(x_tmp)
+    def __len__(self):
+        return len(self.names)
 
-    # Calculate line fits for each calibration point
-    linefits = {}
+    def __getitem__(self, video):
+        if video in self.index:
+            return GazeCorrection(self.matrices[self.index[video]])
+        return GazeCorrection(self.default)
 
-    for i in range(1, 5):
-        tmp = {}
 
-        m, b = np.polyfit(x, cp_ordered_data[cfg.CALIBRATION_POINT_NAMES[i]][0], 1)
-        tmp['x'] = [m, b]
+def get_correction_table(subject, use_cache=True, average_gaze_data=None):
+    """
+    Calculate the correction matrix of every video of a subject.
+    The gaze error of the corner calibration points is fitted with a line over time and the matrix of a video
+    corrects the errors estimated for the middle of the video.
+    use_cache and average_gaze_data are as in get_correction_func_dispenser
+    Returns a CorrectionTable
+    """
+    if average_gaze_data is None:
+        average_gaze_data = get_cp_averages(subject, use_cache)
+    timeline = Timeline(get_timeline(subject))
 
-        m, b = np.polyfit(x, cp_ordered_data[cfg.CALIBRATION_POINT_NAMES[i]][1], 1)
-        tmp['y'] = [m, b]
+    # Get x axis values for line fitting
+    times = np.array([timeline.start_time(x) for x in average_gaze_data], dtype=np.float64)
+    slopes, intercepts = fit_corner_drift(times, average_gaze_data)
 
-        linefits[cfg.CALIBRATION_POINT_NAMES[i]] = tmp
+    # Get time from middle of every video, the last one is for videos that are not in the timeline
+    middle = np.append((timeline.starts + timeline.ends) / 2, timeline.total)
 
-    def get_transform_matrix_at_time(video):
-        # Use the estimated average position of the five calibration points to calculate
-        # perspective transform matrix
+    # Use the estimated position of the corner calibration points to calculate the perspective transform matrices
+    corners = np.array(cfg.CALIBRATION_POINT_LOCATIONS[1:5], dtype=np.float64)
+    estimated = corners + (middle[:, np.newaxis, np.newaxis] * slopes + intercepts)
 
-        # Get time from middle of video
-        time = (get_video_start_time(timeline, video) + get_video_end_time(timeline, video)) / 2
+    # Note: in OpenCV, y is positive downwards
+    # In Pupil Labs software, y is positive upwards
+    # The y-axis is flipped when applying the transform in 'gaze_to_frame.py'
+    matrices = get_perspective_transforms(estimated, np.broadcast_to(corners, estimated.shape))
 
-        tmp = []
-        # Use only the corner calibration points
-        for i in range(1, 5):
-            m = linefits[cfg.CALIBRATION_POINT_NAMES[i]]['x'][0]
-            b = linefits[cfg.CALIBRATION_POINT_NAMES[i]]['x'][1]
-            x_pos = m * time + b
+    return CorrectionTable(timeline.names, matrices[:-1], matrices[-1])
 
-            m = linefits[cfg.CALIBRATION_POINT_NAMES[i]]['y'][0]
-            b = linefits[cfg.CALIBRATION_POINT_NAMES[i]]['y'][1]
-            y_pos = m * time + b
 
-            tmp.append([cfg.CALIBRATION_POINT_LOCATIONS[i][0] + x_pos, cfg.CALIBRATION_POINT_LOCATIONS[i][1] + y_pos])
+def save_correction_table(path, table):
+    """
+    Save a CorrectionTable as npz so that other tools can use the matrices without the calibration data
+    """
+    # np.savez adds .npz to names without it
+    tmp_path = "{}.{}.tmp.npz".format(path[:-4] if path.endswith(".npz") else path, os.getpid())
+    np.savez(tmp_path, names=np.array(table.names, dtype=str), matrices=table.matrices, default=table.default)
+    os.replace(tmp_path, path)
 
-        # Note: in OpenCV, y is positive downwards
-        # In Pupil Labs software, y is positive upwards
-        # The y-axis is flipped when applying the transform in 'gaze_to_frame.py'
-        pts1 = np.float32(tmp)
-        pts2 = np.float32([cfg.CALIBRATION_POINT_LOCATIONS[1],
-                           cfg.CALIBRATION_POINT_LOCATIONS[2],
-                           cfg.CALIBRATION_POINT_LOCATIONS[3],
-                           cfg.CALIBRATION_POINT_LOCATIONS[4]])
 
-        mat = cv2.getPerspectiveTransform(pts1, pts2)
+def load_correction_table(path):
+    with np.load(path) as data:
+        return CorrectionTable(data["names"].tolist(), data["matrices"], data["default"])
 
-        def correct_coordinates(x, y):
-            tmp = np.float32([[[x, y]]])
-            corr_tmp = cv2.perspectiveTransform(tmp, mat)
-            return corr_tmp[0, 0]
 
-        return correct_coordinates
+def get_correction_func_dispenser(subject, use_cache=True, average_gaze_data=None):
+    """
+    Get the gaze point correction function for given subject.
+    
+    subject is the root folder which contains the video data for said subject 
+    use_cache=False recomputes the calibration analysis instead of reading it from the cache
+    average_gaze_data is the output of get_cp_averages if it has already been calculated
+    Returns a function that gives a GazeCorrection object for a video name
+    """
+    table = get_correction_table(subject, use_cache, average_gaze_data)
+
+    def get_transform_matrix_at_time(video):
+        return table[video]
 
     return get_transform_matrix_at_time
 
 
 if __name__ == "__main__":
-    pass
+    # Report how far the fast clustering mode moves the calibration point averages
+    # Usage: python get_correction_func.py <subject folder> [<subject folder> ...]
+    import sys
+
+    distances = []
+    for subject_path in sys.argv[1:]:
+        for calibration, cp, exact, fast, distance in cluster_mode_report(subject_path):
+            print("{} {} {:>12} exact ({:.5f}, {:.5f}) fast ({:.5f}, {:.5f}) distance {:.5f}".format(
+                os.path.basename(os.path.normpath(subject_path)), calibration, cp,
+                exact[0], exact[1], fast[0], fast[1], distance))
+            distances.append(distance)
+
+    if distances:
+        print("Mean distance {:.5f}, max distance {:.5f}".format(np.average(distances), np.max(distances)))
@@ -1,74 +1,558 @@
-from math import sqrt
+from functools import lru_cache
+from queue import Queue
+from threading import Event, Thread
+import argparse
+import glob
+import shutil
+import subprocess
+import time
 import numpy as np
 import os
 import cv2
 
-
-def euclidean_distance(center, point):
-    return sqrt((center[0] - point[0]) ** 2 + (center[1] - point[1]) ** 2)
+from gaze_results import load_gaze_results
+from task_graph import TaskGraph
 
 
 def generate_gaze_center(image_width):
+    """
+    Returns the size of the gaze kernel and the kernel: a cone with its peak in the center
+    """
     gaze_size = image_width // 15
     gaze_size += gaze_size % 2
-    arr = np.zeros(shape=(gaze_size, gaze_size), dtype=np.float64)
-    center = (gaze_size / 2, gaze_size / 2,)
-    for y in range(gaze_size):
-        for x in range(gaze_size):
-            arr[y, x] = max(0., gaze_size // 2 - euclidean_distance(center, (x, y)))
+    y, x = np.indices((gaze_size, gaze_size), dtype=np.float64)
+    arr = np.maximum(0., gaze_size // 2 - np.hypot(x - gaze_size / 2, y - gaze_size / 2))
 
     return gaze_size, arr
 
 
-def get_gaze_points(video):
-    frames = [[] for i in range(1000)]
-    maximum = 0
-    for person in os.listdir(video):
-        with open(os.path.join(video, person), "r") as gaze_file:
-            gaze_file.__next__()
-            for row in gaze_file:
-                data = [float(x) for x in row.split(",")]
-                frames[int(data[0])].append((int(round(data[1])), (int(round(data[2])))))
-                maximum = max(maximum, data[0])
+@lru_cache(maxsize=None)
+def get_gaze_kernel(image_width):
+    """
+    The gaze kernel as float32, generated once per resolution
+    """
+    gaze_size, arr = generate_gaze_center(image_width)
+    arr = arr.astype(np.float32)
+    arr.flags.writeable = False
 
-    return frames[:int(maximum)]
+    return gaze_size, arr
 
 
-def write_video(video, gaze_points, out_video_name):
-    print("Started: " + os.path.basename(video))
-    resolution = [int(x) for x in os.path.basename(video).split("_")[1].split("x")]
-    input_video = cv2.VideoCapture(video)
-    out_video = cv2.VideoWriter(out_video_name, cv2.VideoWriter_fourcc(*"X264"), input_video.get(cv2.CAP_PROP_FPS),
-                                (resolution[0], resolution[1]), 1)
-    gaze_size, gaze_center = generate_gaze_center(int(resolution[0]))
-    offset = gaze_size // 2
+class HeatmapRenderer:
+    """
+    Draws gaze heatmaps over video frames of one resolution.
+    All buffers are allocated once and reused for every frame
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.gaze_size, self.kernel = get_gaze_kernel(width)
+        self.offset = self.gaze_size // 2
+
+        # The canvas has room for the kernel to extend over the frame edges
+        self.canvas = np.zeros((height + self.gaze_size, width + self.gaze_size), dtype=np.float32)
+        self.normalized = np.zeros(self.canvas.shape, dtype=np.uint8)
+        self.colored = np.zeros(self.canvas.shape + (3,), dtype=np.uint8)
+        self.output = np.zeros((height, width, 3), dtype=np.uint8)
+
+    def accumulate(self, points, weights=None, clear=True):
+        """
+        Add the kernel at every (x, y) point to the canvas, scaled by the weight of the point if given.
+        clear=False adds to the previous contents of the canvas
+        """
+        if clear:
+            self.canvas.fill(0)
+        gaze_size = self.gaze_size
+        if weights is None:
+            for x, y in points:
+                self.canvas[y:y + gaze_size, x:x + gaze_size] += self.kernel
+        else:
+            for (x, y), weight in zip(points, weights):
+                self.canvas[y:y + gaze_size, x:x + gaze_size] += weight * self.kernel
+
+        return self.canvas
+
+    def colorize(self):
+        """
+        Returns the canvas without the margins as a colormapped image
+        """
+        cv2.normalize(self.canvas, self.normalized, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+        cv2.applyColorMap(self.normalized, cv2.COLORMAP_JET, self.colored)
+
+        offset = self.offset
+        return self.colored[offset:-offset, offset:-offset]
+
+    def render(self, points, image, out=None):
+        """
+        Returns image blended with the heatmap of points.
+        The result is written to out if given, otherwise to an array that is reused by the next call
+        """
+        if out is None:
+            out = self.output
+
+        self.accumulate(points)
+        cv2.addWeighted(self.colorize(), 0.5, image, 0.5, 0, out)
+
+        return out
+
+
+class ScaledCapture:
+    """
+    A video capture that returns the frames resized to size
+    """
+
+    def __init__(self, capture, size):
+        self.capture = capture
+        self.size = size
+
+    def read(self):
+        suc, image = self.capture.read()
+        if suc:
+            image = cv2.resize(image, self.size, interpolation=cv2.INTER_AREA)
+        return suc, image
+
+
+class ScaledWriter:
+    """
+    A video writer that resizes the frames to size before writing them
+    """
+
+    def __init__(self, writer, size):
+        self.writer = writer
+        self.size = size
+
+    def write(self, image):
+        self.writer.write(cv2.resize(image, self.size, interpolation=cv2.INTER_LINEAR))
+
+
+def get_resolution(video):
+    # Format: name_resolution_fps.
+    return [int(x) for x in os.path.basename(video).split("_")[1].split("x")]
+
+
+def scale_gaze_points(gaze_points, scale):
+    """
+    Divide the gaze points of every frame by scale
+    """
+    return [np.asarray(row).reshape(-1, 2) // scale for row in gaze_points]
+
+
+def get_gaze_points(video, use_cache=False):
+    """
+    Returns the rounded gaze points of all subjects as an (N, 2) array for every frame of a video.
+    video is the folder of the video in the results directory
+    """
+    return load_gaze_results(video, use_cache).frame_points()
+
+
+class StageStats:
+    """
+    Frame count and busy time of each stage of the heatmap video writer
+    """
+
+    def __init__(self, stages=("decode", "render", "encode")):
+        self.frames = {x: 0 for x in stages}
+        self.busy = {x: 0. for x in stages}
+        self.start = time.perf_counter()
+        self.elapsed = 0.
+
+    def add(self, stage, seconds):
+        self.frames[stage] += 1
+        self.busy[stage] += seconds
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.start
+
+    def report(self, name):
+        frames = self.frames["encode"]
+        print("{}: {} frames in {:.1f} s, {:.1f} fps".format(name, frames, self.elapsed,
+                                                             frames / self.elapsed if self.elapsed else 0.))
+        for stage in self.busy:
+            busy = self.busy[stage]
+            print("    {:<7} {:>6} frames {:>8.1f} s busy {:>8.1f} fps".format(
+                stage, self.frames[stage], busy, self.frames[stage] / busy if busy else 0.))
+        print("    Bottleneck: {}".format(max(self.busy, key=self.busy.get)))
+
+
+def write_frames(input_video, out_video, renderer, gaze_points, name, stats):
+    """
+    Decode, render and encode every frame in sequence on the calling thread
+    """
     for i, row in enumerate(gaze_points):
         if i and i % 50 == 0:
-            print("{}th frame of {}.".format(i, os.path.basename(video)))
-        blank = np.zeros(shape=(resolution[1] + gaze_size, resolution[0] + gaze_size), dtype=np.float64)
-        for gaze in row:
-            blank[gaze[1]:gaze[1] + gaze_size, gaze[0]:gaze[0] + gaze_size] += gaze_center
-        a = np.zeros(blank.shape, np.uint8)
-        a = cv2.normalize(blank, a, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=np.uint8())
-        b = cv2.applyColorMap(a, cv2.COLORMAP_JET)
+            print("{}th frame of {}.".format(i, name))
 
+        start = time.perf_counter()
         suc, image = input_video.read()
         if not suc:
-            print("too many frames " + video)
+            print("too many frames " + name)
             break
-        out_video.write(cv2.addWeighted(b[offset:-offset, offset:-offset], 0.5, image, 0.5, 0))
+        stats.add("decode", time.perf_counter() - start)
 
-    out_video.release()
-    input_video.release()
+        start = time.perf_counter()
+        frame = renderer.render(row, image)
+        stats.add("render", time.perf_counter() - start)
 
+        start = time.perf_counter()
+        out_video.write(frame)
+        stats.add("encode", time.perf_counter() - start)
+
+
+def write_frames_pipelined(input_video, out_video, renderer, gaze_points, name, stats, queue_size=8):
+    """
+    Decode and encode on their own threads while the calling thread renders.
+    The stages are connected by queues of at most queue_size frames.
+    OpenCV releases the GIL while decoding, rendering and encoding so the stages run in parallel
+    """
+    decoded = Queue(queue_size)
+    rendered = Queue()
+    # Output frames are reused once the encoder has written them. This also bounds the rendered queue
+    free = Queue()
+    for _ in range(queue_size + 1):
+        free.put(np.empty((renderer.height, renderer.width, 3), dtype=np.uint8))
+
+    stop = Event()
+    errors = []
+
+    def decode():
+        try:
+            for _ in gaze_points:
+                if stop.is_set():
+                    break
+                start = time.perf_counter()
+                suc, image = input_video.read()
+                if not suc:
+                    print("too many frames " + name)
+                    break
+                stats.add("decode", time.perf_counter() - start)
+                decoded.put(image)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            decoded.put(None)
+
+    def encode():
+        while True:
+            frame = rendered.get()
+            if frame is None:
+                break
+            # After an error the remaining frames are only returned so that rendering does not block
+            if not errors:
+                try:
+                    start = time.perf_counter()
+                    out_video.write(frame)
+                    stats.add("encode", time.perf_counter() - start)
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+            free.put(frame)
+
+    threads = [Thread(target=decode, daemon=True), Thread(target=encode, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    # Whether the None that the decoder puts last has been taken from the queue
+    decoder_done = False
+    try:
+        for i, row in enumerate(gaze_points):
+            image = decoded.get()
+            if image is None:
+                decoder_done = True
+                break
+            if i and i % 50 == 0:
+                print("{}th frame of {}.".format(i, name))
+
+            frame = free.get()
+            start = time.perf_counter()
+            renderer.render(row, image, frame)
+            stats.add("render", time.perf_counter() - start)
+            rendered.put(frame)
+    finally:
+        stop.set()
+        # Let the decoder finish if it is waiting for room in the queue. The decoder always ends with None,
+        # so the queue is drained up to it unless it has been taken already
+        while not decoder_done:
+            decoder_done = decoded.get() is None
+        rendered.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
 
-if __name__ == "__main__":
-    result_dir = r"D:\exports_4"
-    video_dir = r"D:\Raw_Files\eye_tracking_final_sequences_y4m"
-    output_dir = r"D:\exports_4\heatmaps"
 
-    for video in os.listdir(video_dir):
-        if video == "blank":
+def write_video(video, gaze_points, out_video_name, pipelined=True, queue_size=8, start_frame=0, scale=1):
+    """
+    Write the video with the gaze heatmap of every frame drawn over it.
+    gaze_points is a list of (x, y) points for every frame
+    pipelined runs decoding and encoding on their own threads, queue_size is the number of frames
+    buffered between the stages.
+    start_frame is the input frame that the first gaze points belong to. Seeking is exact for y4m videos
+    scale > 1 writes a proxy video: the heatmap is drawn on frames downscaled by scale and the result
+    is upsampled back to the resolution of the video, so it can be used in place of the full quality video
+    Prints and returns the throughput of each stage as a StageStats
+    """
+    print("Started: " + os.path.basename(video))
+    resolution = get_resolution(video)
+    input_video = cv2.VideoCapture(video)
+    if start_frame:
+        input_video.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    out_video = cv2.VideoWriter(out_video_name, cv2.VideoWriter_fourcc(*"X264"), input_video.get(cv2.CAP_PROP_FPS),
+                                (resolution[0], resolution[1]), 1)
+    capture = input_video
+    writer = out_video
+    if scale > 1:
+        capture = ScaledCapture(input_video, (resolution[0] // scale, resolution[1] // scale))
+        writer = ScaledWriter(out_video, (resolution[0], resolution[1]))
+        resolution = [resolution[0] // scale, resolution[1] // scale]
+        gaze_points = scale_gaze_points(gaze_points, scale)
+    renderer = HeatmapRenderer(resolution[0], resolution[1])
+    stats = StageStats()
+    name = os.path.basename(video)
+
+    try:
+        if pipelined:
+            write_frames_pipelined(capture, writer, renderer, gaze_points, name, stats, queue_size)
+        else:
+            write_frames(capture, writer, renderer, gaze_points, name, stats)
+    finally:
+        out_video.release()
+        input_video.release()
+
+    stats.stop()
+    stats.report(name)
+
+    return stats
+
+
+def write_attention_maps(video, gaze_points, out_image_name, window=0):
+    """
+    Write the attention map of all gaze points of a video as an image without decoding the video.
+    window > 0 also writes a map for every window of that many frames, named after the first frame of the window.
+    The whole video map is written last.
+    Returns the number of maps written
+    """
+    resolution = get_resolution(video)
+    renderer = HeatmapRenderer(resolution[0], resolution[1])
+    base, extension = os.path.splitext(out_image_name)
+
+    def accumulate(rows, clear):
+        # Points that are looked at in many frames are added once with a weight
+        points = np.concatenate([np.asarray(row, dtype=np.int64).reshape(-1, 2) for row in rows] +
+                                [np.zeros((0, 2), dtype=np.int64)])
+        if len(points):
+            points, counts = np.unique(points, axis=0, return_counts=True)
+            renderer.accumulate(points, counts, clear)
+        elif clear:
+            renderer.canvas.fill(0)
+
+    written = 0
+    if window > 0:
+        totals = np.zeros_like(renderer.canvas)
+        for start in range(0, len(gaze_points), window):
+            accumulate(gaze_points[start:start + window], True)
+            totals += renderer.canvas
+            cv2.imwrite("{}_{:06d}{}".format(base, start, extension), renderer.colorize())
+            written += 1
+        renderer.canvas[...] = totals
+    else:
+        accumulate(gaze_points, True)
+
+    cv2.imwrite(out_image_name, renderer.colorize())
+
+    return written + 1
+
+
+def concatenate_videos(parts, out_video_name):
+    """
+    Join the video files in parts into out_video_name and remove the parts.
+    Uses ffmpeg without re-encoding if it is installed, otherwise the frames are re-encoded with OpenCV
+    """
+    try:
+        join_parts(parts, out_video_name)
+    finally:
+        # The parts are not reused, also when joining fails
+        remove_parts(parts)
+
+
+def join_parts(parts, out_video_name):
+    if len(parts) == 1:
+        os.replace(parts[0], out_video_name)
+        return
+
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg:
+        list_path = out_video_name + ".txt"
+        with open(list_path, "w") as list_file:
+            for part in parts:
+                list_file.write("file '{}'\n".format(os.path.abspath(part).replace("'", "'\\''")))
+        try:
+            subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+                            "-c", "copy", out_video_name], check=True)
+        finally:
+            os.remove(list_path)
+    else:
+        input_video = cv2.VideoCapture(parts[0])
+        size = (int(input_video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(input_video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        out_video = cv2.VideoWriter(out_video_name, cv2.VideoWriter_fourcc(*"X264"),
+                                    input_video.get(cv2.CAP_PROP_FPS), size, 1)
+        input_video.release()
+        for part in parts:
+            input_video = cv2.VideoCapture(part)
+            suc, image = input_video.read()
+            while suc:
+                out_video.write(image)
+                suc, image = input_video.read()
+            input_video.release()
+        out_video.release()
+
+
+def remove_parts(parts):
+    for part in parts:
+        if os.path.lexists(part):
+            os.remove(part)
+
+
+def get_part_name(out_video_name, index):
+    base, extension = os.path.splitext(out_video_name)
+    return "{}.part{:03d}{}".format(base, index, extension)
+
+
+def finish_video(parts, out_video_name, *stats):
+    """
+    Join the rendered chunks of a video. stats are the StageStats of the chunks
+    """
+    concatenate_videos(parts, out_video_name)
+    return sum(x.frames["encode"] for x in stats)
+
+
+def is_up_to_date(out_video_name, inputs):
+    """
+    True if the output exists and is newer than every input file
+    """
+    if not os.path.isfile(out_video_name):
+        return False
+    out_mtime = os.path.getmtime(out_video_name)
+    return all(os.path.getmtime(x) < out_mtime for x in inputs)
+
+
+def add_video(graph, video_path, gaze_dir, out_video_name, chunk_frames=0, pipelined=True, force=False, scale=1,
+              use_cache=False):
+    """
+    Add the tasks of one heatmap video to the task graph: one task per chunk of chunk_frames frames
+    and a task that joins the chunks. chunk_frames=0 renders the whole video in one chunk.
+    scale > 1 renders a proxy video: the heatmap is drawn at the resolution downscaled by scale and upsampled back.
+    use_cache reads the gaze results through the binary cache of load_gaze_results.
+    Videos whose output is newer than the video and the gaze files are skipped unless force is set.
+    Returns True if tasks were added
+    """
+    gaze_files = [os.path.join(gaze_dir, x) for x in os.listdir(gaze_dir)]
+    if not force and is_up_to_date(out_video_name, [video_path] + gaze_files):
+        print("Up to date:", out_video_name)
+        return False
+
+    gaze_points = get_gaze_points(gaze_dir, use_cache)
+    if chunk_frames <= 0:
+        chunk_frames = max(len(gaze_points), 1)
+
+    # Parts left behind by an earlier run whose chunks failed
+    base, extension = os.path.splitext(out_video_name)
+    remove_parts(glob.glob("{}.part[0-9][0-9][0-9]{}".format(glob.escape(base), glob.escape(extension))))
+
+    video = os.path.basename(video_path)
+    parts = []
+    for index, start in enumerate(range(0, max(len(gaze_points), 1), chunk_frames)):
+        part = get_part_name(out_video_name, index)
+        graph.add((video, index), write_video,
+                  (video_path, gaze_points[start:start + chunk_frames], part, pipelined, 8, start, scale))
+        parts.append(part)
+
+    graph.add((video, "join"), finish_video, (parts, out_video_name), dependencies=[(video, x) for x in range(len(parts))])
+
+    return True
+
+
+def add_attention_maps(graph, video_path, gaze_dir, out_image_name, window=0, force=False, use_cache=False):
+    """
+    Add a task that writes the attention maps of one video to the task graph.
+    Skipped if the maps are newer than the video and the gaze files unless force is set.
+    Returns True if the task was added
+    """
+    gaze_files = [os.path.join(gaze_dir, x) for x in os.listdir(gaze_dir)]
+    if not force and is_up_to_date(out_image_name, [video_path] + gaze_files):
+        print("Up to date:", out_image_name)
+        return False
+
+    graph.add((os.path.basename(video_path), "attention"), write_attention_maps,
+              (video_path, get_gaze_points(gaze_dir, use_cache), out_image_name, window))
+
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Render gaze heatmap videos of the test videos")
+    parser.add_argument("result_dir", help="Directory of the corrected gaze data, one folder per video")
+    parser.add_argument("video_dir", help="Directory of the test videos")
+    parser.add_argument("output_dir", help="Directory for the heatmap videos")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--chunk-frames", type=int, default=600,
+                        help="Split videos into chunks of this many frames that are rendered in parallel, "
+                             "0 renders every video in one piece")
+    parser.add_argument("--force", action="store_true",
+                        help="Render videos even if the output is newer than the inputs")
+    parser.add_argument("--sequential", action="store_true",
+                        help="Decode, render and encode each frame in sequence instead of in a pipeline")
+    parser.add_argument("--mode", choices=["overlay", "proxy", "aggregate"], default="overlay",
+                        help="overlay: full resolution heatmap video, "
+                             "proxy: heatmap drawn at the resolution downscaled by --proxy-scale and upsampled back "
+                             "to the full resolution for previews, "
+                             "aggregate: attention map images without decoding the videos")
+    parser.add_argument("--proxy-scale", type=int, default=4,
+                        help="Downscaling factor of the proxy videos")
+    parser.add_argument("--window", type=int, default=0,
+                        help="In aggregate mode also write a map for every window of this many frames")
+    parser.add_argument("--cache", action="store_true",
+                        help="Keep the gaze results of every video in a binary file in the cache directory")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    graph = TaskGraph()
+    for video in sorted(os.listdir(args.video_dir)):
+        gaze_dir = os.path.join(args.result_dir, video)
+        if video == "blank" or not os.path.isdir(gaze_dir):
             continue
-        temp = get_gaze_points(os.path.join(result_dir, video))
-        write_video(os.path.join(video_dir, video), temp, os.path.join(output_dir, video.split(".")[0] + ".mkv"))
+        video_path = os.path.join(args.video_dir, video)
+        out_base = os.path.join(args.output_dir, video.split(".")[0])
+        if args.mode == "aggregate":
+            add_attention_maps(graph, video_path, gaze_dir, out_base + "_attention.png", args.window, args.force, args.cache)
+        elif args.mode == "proxy":
+            add_video(graph, video_path, gaze_dir, out_base + "_proxy.mkv",
+                      args.chunk_frames, not args.sequential, args.force, args.proxy_scale, args.cache)
+        else:
+            add_video(graph, video_path, gaze_dir, out_base + ".mkv",
+                      args.chunk_frames, not args.sequential, args.force, use_cache=args.cache)
+
+    failures = []
+    for name, ok, result in graph.run(args.workers):
+        if not ok:
+            print("Failed:", *name)
+            print(result)
+            failures.append(name)
+        elif name[1] == "join":
+            print("Done: {} ({})".format(name[0], result))
+        elif name[1] == "attention":
+            print("Done: {} ({} maps)".format(name[0], result))
+
+    if failures:
+        print("{} of {} tasks failed".format(len(failures), len(graph.order)))
+
+
+if __name__ == "__main__":
+    main()
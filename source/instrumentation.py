@@ -0,0 +1,54 @@
+import time
+from contextlib import contextmanager
+
+# Metrics of the current process: { span name: [calls, seconds] } and { counter name: value }
+_spans = {}
+_counters = {}
+
+
+@contextmanager
+def span(name):
+    """
+    Time the enclosed block. Nested spans are all counted, so the times of nested stages overlap
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = _spans.setdefault(name, [0, 0.])
+        entry[0] += 1
+        entry[1] += time.perf_counter() - start
+
+
+def count(name, value=1):
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def take_metrics():
+    """
+    Returns the metrics collected in this process since the last call and starts over
+    """
+    metrics = {"spans": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in _spans.items()},
+               "counters": dict(_counters)}
+    _spans.clear()
+    _counters.clear()
+
+    return metrics
+
+
+def merge_metrics(total, metrics):
+    """
+    Add metrics to total. Both are in the format returned by take_metrics
+    """
+    for name, entry in metrics["spans"].items():
+        total_entry = total["spans"].setdefault(name, {"calls": 0, "seconds": 0.})
+        total_entry["calls"] += entry["calls"]
+        total_entry["seconds"] += entry["seconds"]
+    for name, value in metrics["counters"].items():
+        total["counters"][name] = total["counters"].get(name, 0) + value
+
+    return total
+
+
+def empty_metrics():
+    return {"spans": {}, "counters": {}}
@@ -1,11 +1,27 @@
-import sys
+import argparse
+import json
 import os
-from multiprocessing import Pool
+import time
 from shutil import copy
 
+import numpy as np
+
 import config as cfg
+from calibration_cache import clear_cache, file_signature, get_cache_key, get_code_version, get_recording_files, \
+    OUTPUT_CONFIG
 from gaze_to_frame import gaze_to_frame
-from get_correction_func import get_correction_func_dispenser
+from instrumentation import count, empty_metrics, merge_metrics, span, take_metrics
+from get_correction_func import get_calibration_averages, get_calibration_folders, get_correction_table, \
+    save_correction_table
+from task_graph import TaskGraph
+from video_metadata import build_video_index
+
+
+# Formats of the corrected gaze data, see write_result
+OUTPUT_FORMATS = ["csv", "npz"]
+
+# The correction matrices of every video of a subject are saved as output_dir/subject/CORRECTION_TABLE_NAME
+CORRECTION_TABLE_NAME = "corrections.npz"
 
 
 def make_dir(directory):
@@ -24,54 +40,340 @@ def parse_log(log):
     return videos
 
 
-def parse_person(subject):
-    if subject in cfg.IGNORE_PERSON:
-        print("Skipping", subject)
+def get_video_corrections(subject_path, calibrations, table_path, use_cache, *averages):
+    """
+    Fit the correction of a subject from the calibration averages, save the correction matrices
+    of all videos to table_path and return them as a CorrectionTable
+    """
+    table = get_correction_table(subject_path, use_cache, dict(zip(calibrations, averages)))
+    save_correction_table(table_path, table)
+
+    return table
+
+
+@span("write_output")
+def write_result(result_file_path, data, output_format):
+    """
+    Write the frames of data that have gaze as csv or npz
+    """
+    index = np.flatnonzero(~np.isnan(data[:, 0]))
+
+    if output_format == "npz":
+        np.savez(result_file_path, frame_index=index.astype(np.int32), x_coord=data[index, 0], y_coord=data[index, 1])
         return
 
-    if len(sys.argv) >= 2:
-        output_dir = sys.argv[1]
-    else:
-        output_dir = cfg.DEFAULT_OUTPUT_DIRECTORY
+    with open(result_file_path, "w") as gaze_data:
+        gaze_data.write("frame_index,x_coord,y_coord\n")
+        # Coordinates are float32 pixels, more decimals would only print float32 rounding noise
+        gaze_data.writelines("{},{:.4f},{:.4f}\n".format(i, x, y)
+                             for i, x, y in zip(index.tolist(), data[index, 0].tolist(), data[index, 1].tolist()))
+
+
+def link_file(source, destination):
+    """
+    Hardlink destination to source, or copy if the file system does not support links
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        copy(source, destination)
+
+
+def process_video(subject, video, output_dir, output_format, corrections):
+    """
+    Write the corrected gaze of one video of a subject to output_dir/video/subject.<format>
+    and link it as output_dir/subject/video.<format>.
+    Returns the manifest entry of the written file
+    """
+    subject_path = os.path.join(cfg.RESULTS_DIRECTORY, subject)
+
+    # Get the correction factor for this video
+    correction_func = corrections[video]
+
+    make_dir(os.path.join(output_dir, video))
+    frame_rate = int(video.split("_")[2][0:2])
+
+    # The recording is "000" for all normal videos
+    # Only the calibrations folder contains recording numbers other that "000"
+    data = gaze_to_frame(os.path.join(subject_path, video), "000", frame_rate,
+                         correction_func)
+
+    result_file_path = os.path.join(output_dir, video, "{}.{}".format(subject, output_format))
+    write_result(result_file_path, data, output_format)
+    count("bytes_written", os.path.getsize(result_file_path))
+
+    subject_file_path = os.path.join(output_dir, subject, "{}.{}".format(video, output_format))
+    link_file(result_file_path, subject_file_path)
+
+    # A result of an earlier run in the other format would be read as a second copy of the subject
+    for other_format in OUTPUT_FORMATS:
+        if other_format != output_format:
+            for path in (os.path.join(output_dir, video, "{}.{}".format(subject, other_format)),
+                         os.path.join(output_dir, subject, "{}.{}".format(video, other_format))):
+                if os.path.lexists(path):
+                    os.remove(path)
+
+    return {"subject": subject,
+            "video": video,
+            "format": output_format,
+            "path": os.path.relpath(result_file_path, output_dir),
+            "subject_path": os.path.relpath(subject_file_path, output_dir),
+            "frames": len(data),
+            "gaze_frames": int(np.count_nonzero(~np.isnan(data[:, 0])))}
+
+
+def read_manifest(output_dir):
+    """
+    Returns the entries of manifest.json in output_dir as a dictionary { (subject, video): entry }
+    """
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    if not os.path.isfile(manifest_path):
+        return {}
+
+    with open(manifest_path) as manifest_file:
+        return {(x["subject"], x["video"]): x for x in json.load(manifest_file)["files"]}
+
+
+def write_manifest(output_dir, entries):
+    """
+    Add the entries to manifest.json in output_dir. Entries of the same subject and video are replaced
+    """
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    manifest = read_manifest(output_dir)
+
+    for entry in entries:
+        manifest[entry["subject"], entry["video"]] = entry
+
+    tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+    with open(tmp_path, "w") as manifest_file:
+        json.dump({"files": [manifest[x] for x in sorted(manifest)]}, manifest_file, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_input_keys(subject_path, videos, calibrations, output_format, code_version=None):
+    """
+    Returns a key for the inputs of every video output of a subject: the export files of the video and
+    the calibrations, the experiment log, the test videos, the config values, the output format and the code version
+    """
+    if code_version is None:
+        code_version = get_code_version()
+
+    # The correction of every video depends on the whole timeline of the subject.
+    # These files are signed once and shared by the keys of all videos
+    subject_files = [os.path.join(subject_path, "log.txt")]
+    subject_files.extend(os.path.join(cfg.TEST_VIDEO_FOLDER, x) for x in dict.fromkeys(videos))
+    for calibration in calibrations:
+        subject_files.extend(get_recording_files(os.path.join(subject_path, "calibrations"), calibration))
+    subject_signatures = [file_signature(x) for x in subject_files]
+
+    return {video: get_cache_key("output", get_recording_files(os.path.join(subject_path, video), "000"),
+                                 OUTPUT_CONFIG, (output_format, code_version), subject_signatures)
+            for video in dict.fromkeys(videos)}
+
+
+def is_up_to_date(output_dir, entry, key):
+    return (entry is not None and entry.get("status") == "ok" and entry.get("inputs") == key and
+            os.path.isfile(os.path.join(output_dir, entry["path"])) and
+            os.path.isfile(os.path.join(output_dir, entry["subject_path"])))
+
+
+def add_person(graph, subject, output_dir=cfg.DEFAULT_OUTPUT_DIRECTORY, use_cache=True, output_format=None,
+               manifest=None, code_version=None):
+    """
+    Add the tasks of one subject to the task graph:
+    one task per calibration, a correction fit that depends on all of them
+    and one task per video that depends on the correction fit.
+    output_format is "csv" or "npz", cfg.OUTPUT_FORMAT by default
+    manifest is the output manifest of the previous runs as returned by read_manifest. Videos whose manifest entry
+    was built from the same inputs are skipped. None processes every video
+    Returns the input keys of the added videos as a dictionary { video: key },
+    or None when reading the log, calibrations or inputs of the subject fails
+    """
+    if subject in cfg.IGNORE_PERSON:
+        print("Skipping", subject)
+        return {}
 
     subject_path = os.path.join(cfg.RESULTS_DIRECTORY, subject)
     if not os.path.isdir(subject_path):
-        return
+        return {}
 
     make_dir(os.path.join(output_dir, subject))
+    if output_format is None:
+        output_format = cfg.OUTPUT_FORMAT
+
+    # An unreadable subject must not stop the other subjects from being processed
+    try:
+        videos = parse_log(os.path.join(subject_path, "log.txt"))
+        calibrations = get_calibration_folders(subject_path)
+
+        keys = get_input_keys(subject_path, videos, calibrations, output_format, code_version)
+    except Exception as e:
+        print("Failed:", subject, "setup")
+        print(e)
+        return None
+
+    if manifest is not None:
+        keys = {video: key for video, key in keys.items()
+                if not is_up_to_date(output_dir, manifest.get((subject, video)), key)}
+        if not keys:
+            print("Up to date:", subject)
+            return {}
+
+    calibration_tasks = []
+    for calibration in calibrations:
+        name = (subject, "calibration", calibration)
+        graph.add(name, get_calibration_averages, (subject_path, calibration, use_cache))
+        calibration_tasks.append(name)
+
+    graph.add((subject, "correction"), get_video_corrections,
+              (subject_path, calibrations, os.path.join(output_dir, subject, CORRECTION_TABLE_NAME), use_cache),
+              dependencies=calibration_tasks)
+
+    # A video listed twice in the log is only processed once
+    for video in keys:
+        graph.add((subject, "video", video), process_video, (subject, video, output_dir, output_format),
+                  dependencies=[(subject, "correction")])
+
+    return keys
 
-    videos = parse_log(os.path.join(subject_path, "log.txt"))
 
-    function_dispenser = get_correction_func_dispenser(subject_path)
+def write_report(report_path, graph, elapsed, setup_metrics, failures=()):
+    """
+    Write the instrumentation metrics of a run as JSON: the totals, the totals of each subject and every task
+    """
+    total = merge_metrics(empty_metrics(), setup_metrics)
+    subjects = {}
+    tasks = {}
+    for name, metrics in graph.metrics.items():
+        merge_metrics(total, metrics)
+        merge_metrics(subjects.setdefault(name[0], empty_metrics()), metrics)
+        tasks[" ".join(name)] = metrics
 
-    for video in videos:
-        # Get the correction factor for this video
-        correction_func = function_dispenser(video)
+    report = {"elapsed_seconds": elapsed,
+              "tasks_run": len(graph.metrics),
+              "failed_tasks": [" ".join(x) for x in failures],
+              "total": total,
+              "subjects": subjects,
+              "tasks": tasks}
 
-        make_dir(os.path.join(output_dir, video))
-        frame_rate = int(video.split("_")[2][0:2])
+    with open(report_path, "w") as report_file:
+        json.dump(report, report_file, indent=1)
 
-        # The recording is "000" for all normal videos
-        # Only the calibrations folder contains recording numbers other that "000"
-        data = gaze_to_frame(os.path.join(subject_path, video), "000", frame_rate,
-                             correction_func)
 
-        result_file_path = os.path.join(output_dir, video, "{}.csv".format(subject))
+def run_graph(graph, output_dir, input_keys, workers=None, report_path=None, profile_dir=None, setup_failures=()):
+    """
+    Run the task graph and record every video output in the manifest, with its input key.
+    Failed videos are recorded as failed so that the next run retries them.
+    input_keys is a dictionary { (subject, video): key }.
+    report_path writes the timing and counter report of the run as JSON,
+    profile_dir writes the cProfile stats of every task there.
+    setup_failures are the (subject, "setup") names of the subjects that add_person could not add
+    Returns the names of the failed tasks, including setup_failures
+    """
+    # Metrics collected before the tasks, eg. while building the video index
+    setup_metrics = take_metrics()
+    start = time.perf_counter()
 
-        with open(result_file_path, "w") as gaze_data:
-            gaze_data.write("frame_index,x_coord,y_coord\n")
-            for index, gaze in enumerate(data):
-                if gaze:
-                    gaze_data.write("{},{},{}\n".format(index, gaze[0], gaze[1]))
+    failures = list(setup_failures)
+    entries = []
+    for name, ok, result in graph.run(workers, profile_dir):
+        if ok:
+            print("Done:", *name)
+        else:
+            print("Failed:", *name)
+            print(result)
+            failures.append(name)
 
-        copy(result_file_path, os.path.join(output_dir, subject, "{}.csv".format(video)))
+        if name[1] == "video":
+            subject, _, video = name
+            entry = dict(result) if ok else {"subject": subject, "video": video}
+            entry.update(status="ok" if ok else "failed", inputs=input_keys[subject, video])
+            entries.append(entry)
+
+    # The outputs of subjects whose setup failed are marked as failed so that the next run retries them
+    failed_subjects = {x[0] for x in setup_failures}
+    if failed_subjects:
+        entries.extend(dict(entry, status="failed") for (subject, _), entry in read_manifest(output_dir).items()
+                       if subject in failed_subjects)
+
+    write_manifest(output_dir, entries)
+
+    if report_path:
+        write_report(report_path, graph, time.perf_counter() - start, setup_metrics, failures)
+        print("Run report:", report_path)
+
+    return failures
+
+
+def parse_person(subject, output_dir=cfg.DEFAULT_OUTPUT_DIRECTORY, use_cache=True, output_format=None, force=False):
+    """
+    Process a single subject in the calling process.
+    Only videos whose inputs have changed since the last run are processed unless force is set
+    """
+    graph = TaskGraph()
+    manifest = None if force else read_manifest(output_dir)
+    keys = add_person(graph, subject, output_dir, use_cache, output_format, manifest)
+    if keys is None:
+        return
+    run_graph(graph, output_dir, {(subject, video): key for video, key in keys.items()}, workers=1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Correct the gaze data of every subject in RESULTS_DIRECTORY")
+    parser.add_argument("output_dir", nargs="?", default=cfg.DEFAULT_OUTPUT_DIRECTORY,
+                        help="Directory for the corrected gaze data")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Recompute the calibration analysis without reading or writing the cache")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="Remove every entry from the calibration cache before processing")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=cfg.OUTPUT_FORMAT,
+                        help="Format of the corrected gaze data")
+    parser.add_argument("--force", action="store_true",
+                        help="Process every video, also those whose inputs have not changed since the last run")
+    parser.add_argument("--report", default=None,
+                        help="Path of the JSON timing report, defaults to run_report.json in the output directory")
+    parser.add_argument("--profile", default=None, metavar="DIRECTORY",
+                        help="Profile every task with cProfile and write the stats to this directory")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes, defaults to the number of CPUs")
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
     if not cfg.config_check():
         return
-    with Pool(processes=16) as pool:
-        pool.map(parse_person, os.listdir(cfg.RESULTS_DIRECTORY))
+
+    if args.clear_cache:
+        clear_cache()
+
+    # Read the test video metadata once, the workers share the stored index
+    with span("video_index"):
+        build_video_index()
+
+    make_dir(args.output_dir)
+    manifest = None if args.force else read_manifest(args.output_dir)
+    code_version = get_code_version()
+
+    graph = TaskGraph()
+    input_keys = {}
+    setup_failures = []
+    for subject in sorted(os.listdir(cfg.RESULTS_DIRECTORY)):
+        keys = add_person(graph, subject, args.output_dir, not args.no_cache, args.format, manifest, code_version)
+        if keys is None:
+            setup_failures.append((subject, "setup"))
+            continue
+        input_keys.update(((subject, video), key) for video, key in keys.items())
+
+    report_path = args.report or os.path.join(args.output_dir, "run_report.json")
+    failures = run_graph(graph, args.output_dir, input_keys, args.workers, report_path, args.profile, setup_failures)
+
+    if failures:
+        print("{} of {} tasks failed:".format(len(failures), len(graph.order) + len(setup_failures)))
+        for name in failures:
+            print("   ", *name)
 
 
 if __name__ == "__main__":
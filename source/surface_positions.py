@@ -0,0 +1,111 @@
+import os
+from csv import reader
+
+import numpy as np
+
+from instrumentation import count, span
+
+# Surface corners in normalized surface coordinates (y-axis positive upwards)
+CORNER_COORDINATES = np.array([(0, 1), (1, 1), (1, 0,), (0, 0)], dtype=np.float64)
+
+# Column indexes in the Pupil surface position export
+FRAME_IDX = 0
+TIMESTAMP = 1
+M_TO_SCREEN = 2
+
+# Record layout of the binary sidecar
+# frame is the frame index of the export, matrix is the surface to world image transform
+# and corners are the surface corners projected to normalized world image coordinates
+SURFACE_DTYPE = np.dtype([("frame", np.int64),
+                          ("timestamp", np.float64),
+                          ("matrix", np.float64, (3, 3)),
+                          ("corners", np.float64, (4, 2))])
+
+
+def parse_surface_matrices(matrix_strings):
+    """
+    Parse a list of 3x3 matrix strings from the surface export into an (N, 3, 3) array.
+    Rows without a matrix (surface not detected) are filled with NaN
+    """
+    matrices = np.full((len(matrix_strings), 3, 3), np.nan, dtype=np.float64)
+    valid = np.array([len(x.strip()) > 0 for x in matrix_strings], dtype=bool)
+
+    if valid.any():
+        text = " ".join(x for x, v in zip(matrix_strings, valid) if v)
+        values = np.array(text.replace("[", " ").replace("]", " ").split(), dtype=np.float64)
+        matrices[valid] = values.reshape(-1, 3, 3)
+
+    return matrices
+
+
+def project_corners(matrices):
+    """
+    Project the surface corners with every matrix at once.
+    Returns an (N, 4, 2) array of normalized world image coordinates
+    """
+    corners = np.column_stack((CORNER_COORDINATES, np.ones(len(CORNER_COORDINATES))))
+    projected = np.matmul(matrices, corners.T).transpose(0, 2, 1)
+
+    return projected[..., :2] / projected[..., 2:]
+
+
+@span("surface_parse")
+def read_surface_csv(csv_file_path):
+    """
+    Read the Pupil surface position export into a SURFACE_DTYPE array
+    """
+    frames = []
+    timestamps = []
+    matrix_strings = []
+    with open(csv_file_path) as csvfile:
+        datareader = reader(csvfile)
+        # Skip header
+        datareader.__next__()
+        for row in datareader:
+            frames.append(row[FRAME_IDX])
+            timestamps.append(row[TIMESTAMP])
+            matrix_strings.append(row[M_TO_SCREEN])
+    count("surface_rows_parsed", len(frames))
+
+    surfaces = np.zeros(len(frames), dtype=SURFACE_DTYPE)
+    surfaces["frame"] = np.array(frames, dtype=np.int64)
+    surfaces["timestamp"] = np.array(timestamps, dtype=np.float64)
+    surfaces["matrix"] = parse_surface_matrices(matrix_strings)
+    surfaces["corners"] = project_corners(surfaces["matrix"])
+
+    return surfaces
+
+
+def get_sidecar_path(csv_file_path):
+    return os.path.splitext(csv_file_path)[0] + ".npy"
+
+
+def load_surface_positions(csv_file_path, use_sidecar=True):
+    """
+    Returns the surface positions of an export as a SURFACE_DTYPE array.
+    The parsed positions are stored in a .npy sidecar next to the export. Later calls
+    memory-map the sidecar instead of parsing the csv again, as long as it is newer than the csv.
+    """
+    if not use_sidecar:
+        return read_surface_csv(csv_file_path)
+
+    sidecar_path = get_sidecar_path(csv_file_path)
+    if os.path.isfile(sidecar_path) and os.path.getmtime(sidecar_path) >= os.path.getmtime(csv_file_path):
+        surfaces = np.load(sidecar_path, mmap_mode="r")
+        if surfaces.dtype == SURFACE_DTYPE:
+            return surfaces
+
+    surfaces = read_surface_csv(csv_file_path)
+
+    # Write through a temporary file so that parallel workers never see a partial sidecar
+    tmp_path = "{}.{}.tmp".format(sidecar_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as sidecar:
+            np.save(sidecar, surfaces)
+        os.replace(tmp_path, sidecar_path)
+    except OSError:
+        # Read only export folder. Continue without the sidecar
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return surfaces
@@ -0,0 +1,240 @@
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+import config as cfg
+
+# World camera of the synthetic recordings
+WORLD_FPS = 30
+WORLD_RESOLUTION = (1280, 720)
+
+# Black frames at the start of every recording, before the screen lights up
+BLACK_FRAMES = 8
+
+# Calibration symbols: frames shown, frames between symbols and fade in / fade out length
+SYMBOL_FRAMES = 45
+SYMBOL_SPACING = 60
+SYMBOL_FADE_FRAMES = 5
+
+# Gaze samples per second and the gaps caused by blinks
+GAZE_RATE = 240
+BLINK_INTERVAL = 2.7
+BLINK_DURATION = 0.15
+
+# Pupil recordings start from an arbitrary clock value
+START_TIME = 100.
+
+
+def format_matrix(matrix):
+    # Same layout as the matrices in the Pupil surface export
+    return np.array2string(matrix, precision=8)
+
+
+def get_surface_matrix(t):
+    """
+    The transformation from normalized screen surface coordinates to normalized world image coordinates at time t.
+    The screen wobbles slightly as if the head of the subject was moving
+    """
+    source = np.float32([[0, 0], [1, 0], [1, 1], [0, 1]])
+    wobble = 0.01 * np.sin(t)
+    destination = np.float32([[0.1 + wobble, 0.12], [0.9, 0.1 + wobble], [0.88 - wobble, 0.9], [0.12, 0.88 + wobble]])
+    return cv2.getPerspectiveTransform(source, destination).astype(np.float64)
+
+
+def render_world_frame(screen, surface_matrix):
+    """
+    Draw the screen image into the world camera image with the surface transformation
+    """
+    width, height = WORLD_RESOLUTION
+    # Screen pixels (y down) -> normalized surface (y up) -> normalized image (y up) -> image pixels (y down)
+    screen_to_surface = np.array([[1 / width, 0, 0], [0, -1 / height, 1], [0, 0, 1]])
+    image_to_pixels = np.array([[width, 0, 0], [0, -height, height], [0, 0, 1]])
+    return cv2.warpPerspective(screen, image_to_pixels @ surface_matrix @ screen_to_surface, (width, height))
+
+
+def is_blink(t):
+    return (t - START_TIME) % BLINK_INTERVAL > BLINK_INTERVAL - BLINK_DURATION
+
+
+def write_recording(path, n_frames, draw_screen, get_gaze, fixations, rng):
+    """
+    Write world.mp4 and the Pupil surface export of one recording.
+    draw_screen(frame) returns the screen image of a frame
+    get_gaze(frame, t) returns the normalized gaze position at time t, or None during blinks
+    fixations is a list of (start frame, end frame, x, y)
+    """
+    surfaces_path = os.path.join(path, "exports", "000-{:03d}".format(n_frames - 1), "surfaces")
+    os.makedirs(surfaces_path, exist_ok=True)
+
+    video = cv2.VideoWriter(os.path.join(path, "world.mp4"), cv2.VideoWriter_fourcc(*"mp4v"), WORLD_FPS,
+                            WORLD_RESOLUTION)
+    with open(os.path.join(surfaces_path, "srf_positons_screen.csv"), "w") as srf_file:
+        srf_file.write("frame_idx,timestamp,m_to_screen,m_from_screen,detected_markers\n")
+        for frame in range(n_frames):
+            surface_matrix = get_surface_matrix(frame / WORLD_FPS)
+            srf_file.write('{},{},"{}","{}",4\n'.format(frame, START_TIME + frame / WORLD_FPS,
+                                                         format_matrix(surface_matrix),
+                                                         format_matrix(np.linalg.inv(surface_matrix))))
+            video.write(render_world_frame(draw_screen(frame), surface_matrix))
+    video.release()
+
+    with open(os.path.join(surfaces_path, "gaze_positions_on_surface_screen.csv"), "w") as gaze_file:
+        gaze_file.write("world_timestamp,world_frame_idx,gaze_timestamp,x_norm,y_norm,x_scaled,y_scaled,"
+                        "on_srf,confidence\n")
+        t = START_TIME
+        while t < START_TIME + n_frames / WORLD_FPS:
+            frame = int((t - START_TIME) * WORLD_FPS)
+            gaze = get_gaze(frame, t)
+            if gaze is not None:
+                gaze_file.write("{},{},{},{},{},{},{},True,0.9\n".format(
+                    START_TIME + frame / WORLD_FPS, frame, t, gaze[0], gaze[1], gaze[0] * 100, gaze[1] * 100))
+            t += 1. / GAZE_RATE * rng.uniform(0.9, 1.1)
+
+    with open(os.path.join(surfaces_path, "fixations_on_surface_screen.csv"), "w") as fixation_file:
+        fixation_file.write("id,start_timestamp,duration,start_frame,end_frame,norm_pos_x,norm_pos_y,"
+                            "x_scaled,y_scaled,on_srf\n")
+        for i, (start, end, x, y) in enumerate(fixations):
+            fixation_file.write("{},{},{},{},{},{},{},{},{},True\n".format(
+                i, START_TIME + start / WORLD_FPS, (end - start) / WORLD_FPS, start, end, x, y, x * 100, y * 100))
+
+
+def write_calibration(path, drift, rng):
+    """
+    A calibration recording: the calibration symbols fade in and out at cfg.CALIBRATION_POINT_LOCATIONS
+    in order while the gaze follows them with the given (x, y) drift. 5 % of the gaze samples are outliers
+    """
+    width, height = WORLD_RESOLUTION
+    schedule = [(BLACK_FRAMES + 10 + i * SYMBOL_SPACING, BLACK_FRAMES + 10 + i * SYMBOL_SPACING + SYMBOL_FRAMES)
+                for i in range(cfg.CALIBRATION_POINTS_AMOUNT)]
+    n_frames = schedule[-1][0] + SYMBOL_SPACING + 10
+
+    def draw_screen(frame):
+        image = np.full((height, width, 3), 255 if frame >= BLACK_FRAMES else 0, np.uint8)
+        for point, (start, end) in enumerate(schedule):
+            if start <= frame < end:
+                fade = min(1., (frame - start) / SYMBOL_FADE_FRAMES, (end - frame) / SYMBOL_FADE_FRAMES)
+                location = cfg.CALIBRATION_POINT_LOCATIONS[point]
+                cv2.circle(image, (int(location[0] * width), int((1 - location[1]) * height)), 40,
+                           (int(255 * (1 - fade)),) * 3, -1)
+        return image
+
+    def get_gaze(frame, t):
+        if is_blink(t):
+            return None
+        point = 0
+        for i, (start, end) in enumerate(schedule):
+            if frame >= start:
+                point = i
+        location = cfg.CALIBRATION_POINT_LOCATIONS[point]
+        if rng.random() < 0.05:
+            return location[0] + rng.normal(0, 0.1), location[1] + rng.normal(0, 0.1)
+        return location[0] + drift[0] + rng.normal(0, 0.005), location[1] + drift[1] + rng.normal(0, 0.005)
+
+    fixations = [(start + 3, start + 20, cfg.CALIBRATION_POINT_LOCATIONS[point][0] + drift[0],
+                  cfg.CALIBRATION_POINT_LOCATIONS[point][1] + drift[1])
+                 for point, (start, end) in enumerate(schedule)]
+
+    write_recording(path, n_frames, draw_screen, get_gaze, fixations, rng)
+
+
+def write_clip(path, n_frames, drift, rng):
+    """
+    A test video recording: a grey screen and a gaze that circles around the screen center with the given drift
+    """
+    width, height = WORLD_RESOLUTION
+
+    def draw_screen(frame):
+        return np.full((height, width, 3), 128 if frame >= BLACK_FRAMES + 4 else 0, np.uint8)
+
+    def get_gaze(frame, t):
+        if is_blink(t):
+            return None
+        return (0.5 + 0.3 * np.sin(t) + drift[0] + rng.normal(0, 0.005),
+                0.5 + 0.3 * np.cos(t) + drift[1] + rng.normal(0, 0.005))
+
+    write_recording(path, n_frames, draw_screen, get_gaze, [], rng)
+
+
+def write_y4m(path, width, height, n_frames, fps):
+    """
+    A black y4m test video stand-in. Only the header and size of the file matter to the pipeline
+    """
+    with open(path, "wb") as video:
+        video.write("YUV4MPEG2 W{} H{} F{}:1 Ip A1:1 C420jpeg\n".format(width, height, fps).encode())
+        frame = bytes(width * height * 3 // 2)
+        for _ in range(n_frames):
+            video.write(b"FRAME\n")
+            video.write(frame)
+
+
+def get_test_video_names(n_videos, resolution=(320, 180), fps=30):
+    return ["clip{:02d}_{}x{}_{}.y4m".format(i, resolution[0], resolution[1], fps) for i in range(n_videos)]
+
+
+def generate_dataset(root, subjects=2, videos=8, video_frames=60, seed=0):
+    """
+    Build a synthetic dataset in root:
+    root/videos contains the test video stand-ins and root/results the recordings of every subject as
+    <RESULTS_ROOT>/<SUBJECT>/<VIDEO>/000/exports/<FRAMES>/surfaces/ and
+    <RESULTS_ROOT>/<SUBJECT>/calibrations/<NNN>/exports/<FRAMES>/surfaces/, with a log.txt per subject.
+    Every subject watches all test videos with a calibration check after every cfg.CALIBRATION_CHECK_INTERVAL
+    videos and at the end. The gaze drifts further after every calibration.
+    Returns the test video folder and the results directory
+    """
+    rng = np.random.default_rng(seed)
+    videos_path = os.path.join(root, "videos")
+    results_path = os.path.join(root, "results")
+    os.makedirs(videos_path, exist_ok=True)
+
+    names = get_test_video_names(videos)
+    for name in names:
+        write_y4m(os.path.join(videos_path, name), 320, 180, video_frames, 30)
+
+    # The world recording is a little longer than the test video
+    world_frames = video_frames + 20
+
+    for subject in range(subjects):
+        subject_path = os.path.join(results_path, "{}-m-{}".format(subject + 1, 20 + subject))
+        os.makedirs(subject_path, exist_ok=True)
+
+        # The log has a line for every video in the format of the experiment control script.
+        # Like in the real logs, the calibration checks between the videos are not logged
+        lines = []
+        calibration = 0
+        for i, name in enumerate(names):
+            drift = (0.01 * (calibration + 1), -0.02 * (calibration + 1))
+            write_clip(os.path.join(subject_path, name, "000"), world_frames, drift, rng)
+            lines.append("10:{:02d}:{:02d} started video {} ok".format(*divmod(i + calibration, 60), name))
+
+            # A calibration check after every CALIBRATION_CHECK_INTERVAL videos and after the last video,
+            # so that every video lies between two calibrations
+            if (i + 1) % cfg.CALIBRATION_CHECK_INTERVAL == 0 or i == len(names) - 1:
+                write_calibration(os.path.join(subject_path, "calibrations", "{:03d}".format(calibration)), drift, rng)
+                calibration += 1
+
+        with open(os.path.join(subject_path, "log.txt"), "w") as log:
+            log.write("\n".join(lines) + "\n")
+
+    return videos_path, results_path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Pupil export dataset")
+    parser.add_argument("root", help="Directory for the dataset")
+    parser.add_argument("--subjects", type=int, default=2, help="Number of subjects")
+    parser.add_argument("--videos", type=int, default=8, help="Number of test videos every subject watches")
+    parser.add_argument("--video-frames", type=int, default=60, help="Frames per test video")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    videos_path, results_path = generate_dataset(args.root, args.subjects, args.videos, args.video_frames, args.seed)
+    print("Test videos:", videos_path)
+    print("Results:", results_path)
+    print("Run the pipeline on the dataset with")
+    print("    GAZE_TEST_VIDEO_FOLDER={} GAZE_RESULTS_DIRECTORY={} python main.py <output directory>".format(
+        videos_path, results_path))
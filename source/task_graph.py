@@ -0,0 +1,147 @@
+import cProfile
+import os
+import re
+import traceback
+from multiprocessing import Pool
+from queue import Queue
+
+from instrumentation import span, take_metrics
+
+
+def run_task(func, args, profile_path=None):
+    """
+    Run a single task in a worker. Exceptions are caught and returned as text so that
+    one failing task does not stop the rest of the graph.
+    Returns (ok, result, metrics) where metrics are the instrumentation metrics collected during the task.
+    With profile_path the task runs under cProfile and the stats are written to that file
+    """
+    take_metrics()
+    try:
+        with span("task"):
+            if profile_path:
+                profile = cProfile.Profile()
+                try:
+                    result = profile.runcall(func, *args)
+                finally:
+                    profile.dump_stats(profile_path)
+            else:
+                result = func(*args)
+        return True, result, take_metrics()
+    except Exception:
+        return False, traceback.format_exc(), take_metrics()
+
+
+def get_profile_path(profile_dir, name):
+    if not profile_dir:
+        return None
+    if not isinstance(name, tuple):
+        name = (name,)
+    return os.path.join(profile_dir, re.sub(r"[^\w.-]", "_", "_".join(str(x) for x in name)) + ".prof")
+
+
+class TaskGraph:
+    """
+    A set of tasks with dependencies, executed in a process pool.
+    Each task is called with its own arguments followed by the results of its dependencies.
+    A task is submitted as soon as all of its dependencies have finished.
+    The instrumentation metrics of every finished task are collected in metrics
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.order = []
+        self.metrics = {}
+
+    def add(self, name, func, args=(), dependencies=()):
+        """
+        Add a task. name must be unique and picklable, dependencies is a list of task names
+        that have been added before this task. func must be a module level function
+        """
+        if name in self.tasks:
+            raise ValueError("Duplicate task: {}".format(name))
+        for dependency in dependencies:
+            if dependency not in self.tasks:
+                raise ValueError("Unknown dependency {} for task {}".format(dependency, name))
+
+        self.tasks[name] = (func, tuple(args), list(dependencies))
+        self.order.append(name)
+
+    def run(self, workers=None, profile_dir=None):
+        """
+        Execute the graph with the given number of worker processes (default: cpu count).
+        With workers=1 the tasks run in the calling process.
+        Yields (name, ok, result) in completion order. For failed tasks result is the error text,
+        tasks whose dependencies failed are reported as failed without running.
+        profile_dir writes the cProfile stats of every task to a .prof file in that directory
+        """
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        results = {}
+        failed = set()
+        waiting = {name: set(self.tasks[name][2]) for name in self.order}
+        dependents = {name: [] for name in self.order}
+        for name in self.order:
+            for dependency in self.tasks[name][2]:
+                dependents[dependency].append(name)
+
+        ready = [name for name in self.order if not waiting[name]]
+        completed = Queue()
+        pending = 0
+
+        def get_args(name):
+            func, args, dependencies = self.tasks[name]
+            return func, args + tuple(results[x] for x in dependencies), get_profile_path(profile_dir, name)
+
+        def complete(name, ok, result, metrics=None):
+            # Returns the tasks that became ready and reports the finished ones
+            if metrics is not None:
+                self.metrics[name] = metrics
+            finished = [(name, ok, result)]
+            if ok:
+                results[name] = result
+                newly_ready = []
+                for dependent in dependents[name]:
+                    waiting[dependent].discard(name)
+                    if not waiting[dependent] and dependent not in failed:
+                        newly_ready.append(dependent)
+                return newly_ready, finished
+
+            # Fail everything that depends on this task
+            stack = list(dependents[name])
+            while stack:
+                dependent = stack.pop()
+                if dependent in failed:
+                    continue
+                failed.add(dependent)
+                finished.append((dependent, False, "Dependency failed: {}".format(name)))
+                stack.extend(dependents[dependent])
+            return [], finished
+
+        if workers == 1:
+            while ready:
+                name = ready.pop(0)
+                newly_ready, finished = complete(name, *run_task(*get_args(name)))
+                ready.extend(newly_ready)
+                for item in finished:
+                    yield item
+            return
+
+        with Pool(processes=workers) as pool:
+            while ready or pending:
+                for name in ready:
+                    pool.apply_async(run_task, get_args(name),
+                                     callback=lambda x, name=name: completed.put((name,) + tuple(x)),
+                                     error_callback=lambda e, name=name: completed.put((name, False, repr(e))))
+                    pending += 1
+                ready = []
+
+                item = completed.get()
+                pending -= 1
+                newly_ready, finished = complete(*item)
+                ready.extend(newly_ready)
+                for item in finished:
+                    yield item
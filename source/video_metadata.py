@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+from fractions import Fraction
+
+import config as cfg
+
+# Bytes per pixel for the y4m colour spaces, relative to the luma plane
+Y4M_PLANE_FACTORS = {
+    "420": Fraction(3, 2),
+    "422": Fraction(2),
+    "444": Fraction(3),
+    "444alpha": Fraction(4),
+    "mono": Fraction(1),
+}
+
+# Loaded indexes per test video folder, so that each process reads the index file only once
+_indexes = {}
+# Folders whose index this process has already rebuilt, and the videos that were still missing after it
+_rebuilt = set()
+_missing = set()
+
+
+def get_fps_from_name(video):
+    # FPS is included in every video name. Split and retrieve
+    # Format: name_resolution_fps.
+    substr = video.split('_')
+    if len(substr[2]) > 2:
+        fps = int(substr[2][:2])
+    else:
+        fps = int(substr[2])
+
+    return fps
+
+
+def get_frame_size(width, height, colorspace):
+    """
+    Returns the size of one frame in bytes for a y4m colour space, eg. "420jpeg" or "420p10"
+    """
+    for name, factor in sorted(Y4M_PLANE_FACTORS.items(), key=lambda x: -len(x[0])):
+        if colorspace.startswith(name):
+            # High bit depth samples, eg. 420p10 or mono16, are stored in two bytes
+            depth = colorspace[len(name):]
+            if depth.startswith("p"):
+                depth = depth[1:]
+            bytes_per_sample = 2 if depth.isdigit() and int(depth) > 8 else 1
+
+            return int(width * height * factor) * bytes_per_sample
+
+    raise ValueError("Unsupported y4m colour space: {}".format(colorspace))
+
+
+def read_y4m_metadata(video_file_path):
+    """
+    Read the frame count and fps of a y4m file from its header and file size
+    without decoding any frames. Assumes every frame header has the same length
+    """
+    with open(video_file_path, "rb") as video_file:
+        header = video_file.readline()
+        frame_header = video_file.readline(64)
+
+    params = header.decode("ascii").split()
+    if not params or params[0] != "YUV4MPEG2":
+        raise ValueError("Not a y4m file: {}".format(video_file_path))
+
+    width = height = 0
+    fps = None
+    colorspace = "420jpeg"
+    for param in params[1:]:
+        if param[0] == "W":
+            width = int(param[1:])
+        elif param[0] == "H":
+            height = int(param[1:])
+        elif param[0] == "F":
+            numerator, denominator = param[1:].split(":")
+            fps = Fraction(int(numerator), int(denominator))
+        elif param[0] == "C":
+            colorspace = param[1:]
+
+    frame_size = get_frame_size(width, height, colorspace)
+    if frame_header.startswith(b"FRAME"):
+        frame_header_size = len(frame_header)
+    else:
+        frame_header_size = len(b"FRAME\n")
+
+    frame_count = (os.path.getsize(video_file_path) - len(header)) // (frame_header_size + frame_size)
+
+    return {"frame_count": frame_count, "fps": float(fps) if fps else None}
+
+
+def probe_video_metadata(video_file_path):
+    """
+    Read the metadata of a video that is not y4m by opening it with OpenCV
+    """
+    import cv2
+
+    handle = cv2.VideoCapture(video_file_path)
+    metadata = {"frame_count": int(handle.get(cv2.CAP_PROP_FRAME_COUNT)),
+                "fps": handle.get(cv2.CAP_PROP_FPS) or None}
+    handle.release()
+
+    return metadata
+
+
+def get_index_path(folder):
+    folder_hash = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()
+    return os.path.join(cfg.CACHE_DIRECTORY, "video_metadata_{}.json".format(folder_hash))
+
+
+def load_video_index(folder):
+    """
+    Load the stored index of folder, eg. in a worker process after the main process has built it.
+    Returns None if there is no readable index
+    """
+    try:
+        with open(get_index_path(folder)) as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+    _indexes[os.path.abspath(folder)] = index
+
+    return index
+
+
+def build_video_index(folder=None):
+    """
+    Build or update the metadata index of the test videos in folder and store it in the cache directory.
+    Entries are only re-read for files whose size or modification time has changed.
+    Returns the index as a dictionary { video name: metadata }
+    """
+    if folder is None:
+        folder = cfg.TEST_VIDEO_FOLDER
+
+    index_path = get_index_path(folder)
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+
+    changed = False
+    names = sorted(x for x in os.listdir(folder) if os.path.isfile(os.path.join(folder, x)))
+    for name in names:
+        video_file_path = os.path.join(folder, name)
+        stat = os.stat(video_file_path)
+        entry = index.get(name)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            continue
+
+        try:
+            if name.endswith(".y4m"):
+                metadata = read_y4m_metadata(video_file_path)
+            else:
+                metadata = probe_video_metadata(video_file_path)
+        except (OSError, ValueError) as e:
+            print("Could not read video metadata:", video_file_path, e)
+            continue
+
+        metadata["size"] = stat.st_size
+        metadata["mtime"] = stat.st_mtime
+        index[name] = metadata
+        changed = True
+
+    # Forget removed videos
+    for name in set(index) - set(names):
+        del index[name]
+        changed = True
+
+    if changed:
+        try:
+            os.makedirs(cfg.CACHE_DIRECTORY, exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+            with open(tmp_path, "w") as index_file:
+                json.dump(index, index_file, indent=1)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            print("Could not write video metadata index", index_path, e)
+
+    _indexes[os.path.abspath(folder)] = index
+    _rebuilt.add(os.path.abspath(folder))
+
+    return index
+
+
+def get_video_metadata(video, folder=None):
+    """
+    Returns { "frame_count": int, "fps": float } for a test video.
+    The stored index is loaded on first use and built if there is none. A video that is not in the index
+    rebuilds it at most once per process. Values in cfg.VIDEO_METADATA_OVERRIDES replace the stored ones
+    and videos without fps information fall back to the fps in the file name
+    """
+    if folder is None:
+        folder = cfg.TEST_VIDEO_FOLDER
+    key = os.path.abspath(folder)
+
+    index = _indexes.get(key)
+    if index is None:
+        index = load_video_index(folder)
+    if index is None or (video not in index and key not in _rebuilt):
+        index = build_video_index(folder)
+
+    metadata = {"frame_count": 0, "fps": None}
+    if video in index:
+        metadata.update(frame_count=index[video]["frame_count"], fps=index[video]["fps"])
+    elif (key, video) not in _missing:
+        _missing.add((key, video))
+        print("Video not found in test video folder:", video)
+
+    if metadata["fps"] is None:
+        metadata["fps"] = get_fps_from_name(video)
+
+    metadata.update(cfg.VIDEO_METADATA_OVERRIDES.get(video, {}))
+
+    return metadata
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import LocalOutlierFactor
+
+from detect_outliers import detect_outlier_masks, detect_outliers
+
+# Groups smaller than n_neighbors are expected here
+pytestmark = pytest.mark.filterwarnings("ignore:n_neighbors")
+
+
+def random_groups(rng):
+    # Calibration point errors: a tight cluster with a few outliers at different places and scales
+    groups = []
+    for size in rng.choice([2, 5, 10, 11, 40, 120], size=5):
+        center = rng.uniform(-1, 1, 2)
+        group = center + rng.normal(0, rng.uniform(0.001, 0.05), (size, 2))
+        outliers = rng.random(size) < 0.1
+        group[outliers] += rng.normal(0, 0.3, (np.count_nonzero(outliers), 2))
+        groups.append(group)
+    return groups
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_lof_masks_match_separate_fits(seed):
+    groups = random_groups(np.random.default_rng(seed))
+
+    masks = detect_outlier_masks(groups, "lof")
+
+    for group, mask in zip(groups, masks):
+        expected = LocalOutlierFactor(n_neighbors=10).fit_predict(group) == -1
+        np.testing.assert_array_equal(mask, expected)
+
+
+def test_detect_outliers_indexes():
+    group = random_groups(np.random.default_rng(0))[-1]
+    pred = LocalOutlierFactor(n_neighbors=10).fit_predict(group)
+    np.testing.assert_array_equal(detect_outliers(group), [i for i, p in enumerate(pred) if p == -1])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_knn_masks_match_brute_force(seed):
+    groups = random_groups(np.random.default_rng(seed))
+
+    masks = detect_outlier_masks(groups, "knn", k=3, threshold=0.02)
+
+    for group, mask in zip(groups, masks):
+        distances = np.linalg.norm(group[:, None] - group[None], axis=2)
+        np.testing.assert_array_equal(mask, np.count_nonzero(distances <= 0.02, axis=1) - 1 < 3)
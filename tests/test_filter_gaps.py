@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import config as cfg
+from filter_gaps import filter_gaps
+
+
+def filter_gaps_loop(rows, start_frame):
+    """
+    The row by row blink removal that filter_gaps replaced, for (frame, timestamp) rows
+    """
+    data = []
+    gaps = []
+    previous_time = 0.0
+    for frame, timestamp in rows:
+        if frame >= start_frame:
+            data.append((frame, timestamp))
+            if timestamp - previous_time > cfg.GAZE_STAMP_THRESHOLD:
+                gaps.append(timestamp)
+        previous_time = timestamp
+
+    final_gaps = []
+    cluster_start = 0
+    cluster_end = 0
+    gaps_in_cluster = 0
+    written = False
+    for gap in gaps:
+        if cluster_start == 0:
+            cluster_start = gap
+            cluster_end = gap
+            gaps_in_cluster += 1
+        elif gap - cluster_end < cfg.GAP_THRESHOLD:
+            cluster_end = gap
+            gaps_in_cluster += 1
+            written = False
+        else:
+            final_gaps.append([gaps_in_cluster, cluster_start, cluster_end])
+            written = True
+            cluster_start = gap
+            cluster_end = gap
+            gaps_in_cluster = 1
+    if not written:
+        final_gaps.append([gaps_in_cluster, cluster_start, cluster_end])
+
+    filtered_data = []
+    next_gap = 0
+    for row in data:
+        if row[1] > final_gaps[next_gap][2] and next_gap != len(final_gaps) - 1:
+            next_gap += 1
+        count, start, end = final_gaps[next_gap]
+        if (end - start < cfg.BLINK_REMOVE_THRESHOLD or count < cfg.MISSING_MEASUREMENT_THRESHOLD) \
+                and start - cfg.BLINK_REMOVE_THRESHOLD < row[1] < end + cfg.BLINK_REMOVE_THRESHOLD:
+            continue
+        filtered_data.append(row)
+    return filtered_data
+
+
+def write_gaze_export(path, frames, timestamps):
+    with open(path, "w") as gaze_file:
+        gaze_file.write("world_timestamp,world_frame_idx,gaze_timestamp,x_norm,y_norm,x_scaled,y_scaled,"
+                        "on_srf,confidence\n")
+        for frame, timestamp in zip(frames.tolist(), timestamps.tolist()):
+            gaze_file.write("{},{},{!r},0.5,0.5,50,50,True,0.9\n".format(frame / 30, frame, timestamp))
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_filter_gaps_matches_loop(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    steps = rng.choice([0.004, 0.03, 0.15, 0.3], size=rng.integers(20, 600), p=[0.9, 0.05, 0.03, 0.02])
+    timestamps = np.cumsum(steps) + rng.uniform(0, 1)
+    frames = np.floor(timestamps * 30).astype(np.int64)
+    start_frame = int(rng.integers(0, 10))
+    path = str(tmp_path / "gaze_positions_on_surface_screen.csv")
+    write_gaze_export(path, frames, timestamps)
+
+    result_frames, result_timestamps, _, _ = filter_gaps(path, start_frame)
+
+    expected = filter_gaps_loop(zip(frames.tolist(), timestamps.tolist()), start_frame)
+    np.testing.assert_array_equal(result_frames, [row[0] for row in expected])
+    np.testing.assert_array_equal(result_timestamps, [row[1] for row in expected])
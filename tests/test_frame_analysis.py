@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from frame_analysis import SurfaceFrame
+
+
+def get_frame(sampling):
+    image = np.random.default_rng(0).integers(0, 256, (90, 160, 3), dtype=np.uint8)
+    # The screen is slightly tilted in the world image
+    corners = np.array([[0.05, 0.95], [0.9, 0.98], [0.95, 0.05], [0.02, 0.1]])
+    return SurfaceFrame(0, image, {"frame": 0, "matrix": np.eye(3), "corners": corners}, sampling)
+
+
+@pytest.mark.parametrize("sampling", ["roi", "warp"])
+def test_screen_region_clamped(sampling):
+    frame = get_frame(sampling)
+    warp = get_frame("warp").warp()
+
+    for rectangle in [(10, 20, 40, 50), (-10, -5, 20, 15), (150, 80, 200, 120)]:
+        x_lower, y_lower, x_upper, y_upper = rectangle
+        expected = warp[max(y_lower, 0):y_upper, max(x_lower, 0):x_upper]
+        np.testing.assert_array_equal(frame.screen_region(*rectangle), expected)
+
+
+@pytest.mark.parametrize("sampling", ["roi", "warp"])
+def test_screen_region_outside(sampling):
+    frame = get_frame(sampling)
+
+    assert frame.screen_region(-30, 10, -5, 40) is None
+    assert frame.screen_region(10, 90, 40, 120) is None
+    assert frame.screen_region(160, 10, 200, 40) is None
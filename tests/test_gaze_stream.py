@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+
+from export_files import get_export_file
+from filter_gaps import find_gap_mask, read_export_columns, WORLD_FRAME_IDX, GAZE_TIMESTAMP
+from gaze_stream import GapFilter, GazeStream, read_export_samples
+from gaze_to_frame import gaze_to_frame
+from get_starting_frame import get_starting_frame
+from synthetic_dataset import write_clip
+
+
+def random_stream(rng):
+    # Mostly regular samples with short and long gaps in between
+    steps = rng.choice([0.004, 0.03, 0.15, 0.3], size=rng.integers(50, 800), p=[0.9, 0.05, 0.03, 0.02])
+    timestamps = np.cumsum(steps) + rng.uniform(0, 1)
+    return np.floor(timestamps * 30).astype(np.int64), timestamps
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_gap_filter_matches_find_gap_mask(seed):
+    rng = np.random.default_rng(seed)
+    frames, timestamps = random_stream(rng)
+    start_frame = int(rng.integers(0, 5))
+
+    gap_filter = GapFilter(start_frame, max_delay=1e9)
+    kept = []
+    for frame, timestamp in zip(frames.tolist(), timestamps.tolist()):
+        kept += gap_filter.push(frame, timestamp, 0., 0.)
+    kept += gap_filter.flush()
+
+    expected = timestamps[find_gap_mask(frames, timestamps, start_frame)]
+    np.testing.assert_array_equal([sample[1] for sample in kept], expected)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_stream_matches_gaze_to_frame(tmp_path, seed):
+    location = str(tmp_path / "clip00_320x180_30.y4m")
+    write_clip(os.path.join(location, "000"), 200, (0.02, -0.01), np.random.default_rng(seed))
+    gaze_file_path = get_export_file(location, "000", "gaze")
+    start_frame = get_starting_frame(location, "000", threshold=22.)
+    samples = list(read_export_samples(gaze_file_path))
+
+    stream = GazeStream(30, [320, 180], start_frame=start_frame, max_delay=1e9)
+    streamed = list(stream.process(samples))
+
+    # The batch pipeline: blink removal with find_gap_mask, then gaze_to_frame on the kept rows
+    frames, timestamps = read_export_columns(gaze_file_path, [WORLD_FRAME_IDX, GAZE_TIMESTAMP],
+                                             [np.int64, np.float64])
+    mask = find_gap_mask(frames, timestamps, start_frame)
+    # The first and last row decide the frame timing, the recording does not start or end with a blink
+    assert mask[np.argmax(frames >= start_frame)] and mask[-1]
+    with open(gaze_file_path) as gaze_file:
+        lines = gaze_file.readlines()
+    with open(gaze_file_path, "w") as gaze_file:
+        gaze_file.writelines([lines[0]] + [line for line, kept in zip(lines[1:], mask) if kept])
+    expected = gaze_to_frame(location, "000", 30)
+
+    result = np.full(expected.shape, np.nan, dtype=np.float32)
+    for frame, x, y in streamed:
+        result[frame] = x, y
+    assert np.count_nonzero(np.isnan(expected[:, 0])) < len(expected)
+    np.testing.assert_allclose(result, expected, rtol=1e-5)
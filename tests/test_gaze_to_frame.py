@@ -0,0 +1,95 @@
+import os
+from math import floor
+
+import numpy as np
+import pytest
+
+import gaze_to_frame as gtf
+from compress_gaze_points import group_by_frame
+
+
+def write_recording(location, frames, timestamps, x, y):
+    surfaces_path = os.path.join(location, "000", "exports", "000-100", "surfaces")
+    os.makedirs(surfaces_path)
+    with open(os.path.join(surfaces_path, "gaze_positions_on_surface_screen.csv"), "w") as gaze_file:
+        gaze_file.write("world_timestamp,world_frame_idx,gaze_timestamp,x_norm,y_norm,x_scaled,y_scaled,"
+                        "on_srf,confidence\n")
+        for row in zip(frames.tolist(), timestamps.tolist(), x.tolist(), y.tolist()):
+            gaze_file.write("0,{},{!r},{!r},{!r},0,0,True,0.9\n".format(*row))
+
+
+def test_group_by_frame_unsorted():
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 20, 500)
+    x = rng.random(500)
+    y = rng.random(500)
+    weights = rng.random(500)
+
+    bins, avg_x, avg_y, counts = group_by_frame(frames, x, y)
+    _, weighted_x, _, _ = group_by_frame(frames, x, y, weights)
+    _, median_x, median_y, _ = group_by_frame(frames, x, y, method="median")
+
+    np.testing.assert_array_equal(bins, sorted(set(frames.tolist())))
+    for i, frame in enumerate(bins):
+        points = frames == frame
+        assert counts[i] == np.count_nonzero(points)
+        assert avg_x[i] == pytest.approx(np.mean(x[points]))
+        assert avg_y[i] == pytest.approx(np.mean(y[points]))
+        assert weighted_x[i] == pytest.approx(np.average(x[points], weights=weights[points]))
+        assert median_x[i] == pytest.approx(np.median(x[points]))
+        assert median_y[i] == pytest.approx(np.median(y[points]))
+
+
+def test_gaze_to_frame_binning_after_gaps(tmp_path, monkeypatch):
+    monkeypatch.setattr(gtf, "get_starting_frame", lambda *args, **kwargs: 2)
+    # 8 samples per frame at 30 fps after two skipped frames. Frames 2-4 have no samples and frame 6 too few
+    samples = [(frame, 100.001 + frame / 30) for frame in (0, 1, 2)]
+    samples += [(frame + 2, 100.001 + (frame + 2) / 30 + 0.002 + 0.003 * i)
+                for frame, count in [(0, 8), (1, 8), (5, 8), (6, 3), (7, 8), (8, 8), (9, 1)] for i in range(count)]
+    frames = np.array([sample[0] for sample in samples])
+    timestamps = np.array([sample[1] for sample in samples])
+    x = 0.1 + frames / 100
+    y = np.full(len(frames), 0.5)
+    location = str(tmp_path / "clip_100x100_30.y4m")
+    write_recording(location, frames, timestamps, x, y)
+
+    result = gtf.gaze_to_frame(location, "000", 30)
+
+    # Frame indices count from the first row of frame 2, the frame of the last row is incomplete and left out
+    assert result.shape == (9, 2) and result.dtype == np.float32
+    valid = [0, 1, 5, 7, 8]
+    assert np.isnan(result[[2, 3, 4, 6]]).all()
+    np.testing.assert_allclose(result[valid, 0], [100 * (0.1 + (frame + 2) / 100) for frame in valid], rtol=1e-6)
+    np.testing.assert_allclose(result[valid, 1], 50)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_gaze_to_frame_matches_sample_loop(tmp_path, monkeypatch, seed):
+    rng = np.random.default_rng(seed)
+    start_frame = int(rng.integers(0, 5))
+    monkeypatch.setattr(gtf, "get_starting_frame", lambda *args, **kwargs: start_frame)
+    steps = rng.choice([1 / 240, 0.03, 0.2], size=2000, p=[0.97, 0.02, 0.01]) * rng.uniform(0.9, 1.1, 2000)
+    timestamps = np.cumsum(steps) + 100
+    frames = np.floor((timestamps - 100) * 30).astype(np.int64)
+    x = rng.uniform(-0.1, 1.1, len(frames))
+    y = rng.uniform(-0.1, 1.1, len(frames))
+    location = str(tmp_path / "clip_320x180_30.y4m")
+    write_recording(location, frames, timestamps, x, y)
+
+    result = gtf.gaze_to_frame(location, "000", 30)
+
+    # Every sample belongs to the frame floor((t - t0) / frametime)
+    first = int(np.argmax(frames >= start_frame))
+    samples = {}
+    for t, point in zip(timestamps[first:].tolist(), zip(x[first:].tolist(), y[first:].tolist())):
+        samples.setdefault(floor((t - timestamps[first]) * 30), []).append(point)
+    n_frames = floor((timestamps[-1] - timestamps[first]) * 30)
+    expected = np.full((n_frames, 2), np.nan)
+    for frame, points in samples.items():
+        if frame < n_frames and len(points) >= 7:
+            point_x = 320 * np.mean([point[0] for point in points])
+            point_y = 180 - 180 * np.mean([point[1] for point in points])
+            if 0 <= point_x <= 320 and 0 <= point_y <= 180:
+                expected[frame] = point_x, point_y
+
+    np.testing.assert_allclose(result, expected, rtol=1e-5)
@@ -0,0 +1,89 @@
+import os
+from math import fabs
+
+import numpy as np
+import pytest
+
+import config as cfg
+import get_calibration_error as gce
+
+
+def write_calibration(location, rng):
+    surfaces_path = os.path.join(location, "000", "exports", "000-400", "surfaces")
+    os.makedirs(surfaces_path)
+
+    # 8 gaze samples per frame without gaps, so filter_gaps only drops the frames before frame 10
+    rows = []
+    t = 100.
+    for frame in range(400):
+        for _ in range(8):
+            rows.append((frame, t, rng.uniform(0, 1), rng.uniform(0, 1)))
+            t += 1 / 240 * rng.uniform(0.99, 1.01)
+    with open(os.path.join(surfaces_path, "gaze_positions_on_surface_screen.csv"), "w") as gaze_file:
+        gaze_file.write("world_timestamp,world_frame_idx,gaze_timestamp,x_norm,y_norm,x_scaled,y_scaled,"
+                        "on_srf,confidence\n")
+        for row in rows:
+            gaze_file.write("0,{},{!r},{!r},{!r},0,0,True,0.9\n".format(*row))
+
+    # Some fixations start exactly on the interval limits used by the test
+    fixations = []
+    for start in sorted(set(rng.choice(400, 60, replace=False).tolist()) | {5, 60, 70, 131, 200, 320}):
+        fixations.append((start, start + int(rng.integers(1, 40)), rng.uniform(0, 1), rng.uniform(0, 1)))
+    with open(os.path.join(surfaces_path, "fixations_on_surface_screen.csv"), "w") as fixation_file:
+        fixation_file.write("id,start_timestamp,duration,start_frame,end_frame,norm_pos_x,norm_pos_y,"
+                            "x_scaled,y_scaled,on_srf\n")
+        for i, (start, end, x, y) in enumerate(fixations):
+            fixation_file.write("{},0,0,{},{},{!r},{!r},0,0,True\n".format(i, start, end, x, y))
+
+    return rows, fixations
+
+
+def get_errors_loop(rows, fixations, points):
+    """
+    The interval scans that get_calibration_error replaced: every interval goes through all frames and fixations
+    """
+    frames = {}
+    for frame, _, x, y in rows:
+        if frame >= 10:
+            frames.setdefault(frame, []).append((x, y))
+    gaze_points = [(frame, np.mean([p[0] for p in xy]), np.mean([p[1] for p in xy])) for frame, xy in frames.items()]
+
+    gaze_error = {}
+    fixation_error = {}
+    for current_point, point in enumerate(points):
+        location_x, location_y = cfg.CALIBRATION_POINT_LOCATIONS[current_point]
+        current_fixations = []
+        for start, end, x, y in fixations:
+            if point[0] < start < point[1]:
+                current_fixations.append([start, min(end, point[1]), x - location_x, y - location_y,
+                                          point[0], point[1]])
+
+        interval = [i for i in gaze_points if point[0] <= i[0] <= point[1]]
+        error_x = [row[1] - location_x for row in interval]
+        error_y = [row[2] - location_y for row in interval]
+        error_comb = [fabs(x) + fabs(y) for x, y in zip(error_x, error_y)]
+
+        name = cfg.CALIBRATION_POINT_NAMES[current_point]
+        gaze_error[name] = [error_x, error_y, error_comb]
+        fixation_error[name] = current_fixations
+
+    return gaze_error, fixation_error
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_intervals_match_loop(tmp_path, monkeypatch, seed):
+    rng = np.random.default_rng(seed)
+    location = str(tmp_path / "1-m-20" / "calibrations")
+    rows, fixations = write_calibration(location, rng)
+    # The first interval overlaps the frames that filter_gaps skips
+    points = [(5, 60), (70, 130), (131, 200), (250, 320), (330, 398)]
+    monkeypatch.setattr(gce, "get_calibration_point_intervals", lambda *args: points)
+
+    gaze_error, fixation_error = gce.get_calibration_error(location, "000", use_cache=False, outlier_method="knn")
+
+    expected_gaze, expected_fixations = get_errors_loop(rows, fixations, points)
+    for name in cfg.CALIBRATION_POINT_NAMES:
+        for values, expected in zip(gaze_error[name], expected_gaze[name]):
+            np.testing.assert_allclose(values, expected, rtol=1e-12, atol=1e-12)
+        assert len(gaze_error[name][3]) == len(expected_gaze[name][0])
+        np.testing.assert_allclose(fixation_error[name].reshape(-1, 6), np.reshape(expected_fixations[name], (-1, 6)))
@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+import pytest
+
+import config as cfg
+from get_correction_func import (Timeline, CorrectionTable, fit_corner_drift, get_perspective_transforms,
+                                 load_correction_table, save_correction_table)
+
+
+def test_perspective_transforms_match_opencv():
+    rng = np.random.default_rng(0)
+    # Calibration point corners moved by a gaze error of a few percent
+    source = np.float32([location for location in cfg.CALIBRATION_POINT_LOCATIONS[1:]])
+    destination = source + rng.normal(0, 0.03, (200, 4, 2))
+    sources = np.broadcast_to(source, destination.shape)
+
+    result = get_perspective_transforms(sources, destination)
+
+    expected = [cv2.getPerspectiveTransform(s, np.float32(d)) for s, d in zip(sources, destination)]
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-9)
+
+
+def test_fit_corner_drift_matches_polyfit():
+    rng = np.random.default_rng(0)
+    times = np.sort(rng.uniform(0, 3000, 6))
+    average_data = {}
+    for n, time in enumerate(times):
+        gaze_error = {name: list(rng.normal(0, 0.05, 2)) + [0.] for name in cfg.CALIBRATION_POINT_NAMES}
+        average_data["{:03d}".format(n)] = {'gaze_error': gaze_error}
+
+    slopes, intercepts = fit_corner_drift(times, average_data)
+
+    for i in range(4):
+        for axis in range(2):
+            errors = [values['gaze_error'][cfg.CALIBRATION_POINT_NAMES[i + 1]][axis]
+                      for values in average_data.values()]
+            m, b = np.polyfit(times, errors, 1)
+            assert slopes[i, axis] == pytest.approx(m, rel=1e-9, abs=1e-15)
+            assert intercepts[i, axis] == pytest.approx(b, rel=1e-9, abs=1e-12)
+
+
+def test_timeline_matches_linear_scan():
+    items = [{'name': "calibration", 'length': 40.5}, {'name': "a.mp4", 'length': 12.},
+             {'name': "b.mp4", 'length': 7.25}, {'name': "calibration", 'length': 38.},
+             {'name': "c.mp4", 'length': 20.}]
+    timeline = Timeline(items)
+
+    for name in ["calibration", "a.mp4", "b.mp4", "c.mp4", "missing.mp4"]:
+        # The loops of the old get_video_start_time and get_video_end_time
+        start = 0
+        for item in items:
+            if item['name'] == name:
+                break
+            start += item['length']
+        end = 0
+        for item in items:
+            end += item['length']
+            if item['name'] == name:
+                break
+        assert timeline.start_time(name) == start
+        assert timeline.end_time(name) == end
+
+
+def test_correction_table_roundtrip(tmp_path):
+    matrices = np.random.default_rng(0).normal(size=(3, 3, 3))
+    table = CorrectionTable(["a.mp4", "b.mp4", "c.mp4"], matrices, np.eye(3))
+    path = str(tmp_path / "corrections.npz")
+
+    save_correction_table(path, table)
+    loaded = load_correction_table(path)
+
+    assert loaded.names == table.names
+    np.testing.assert_array_equal(loaded.matrices, matrices)
+    np.testing.assert_array_equal(loaded.default, np.eye(3))
+    np.testing.assert_array_equal(loaded["b.mp4"].matrix, matrices[1])
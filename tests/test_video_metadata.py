@@ -0,0 +1,60 @@
+import pytest
+
+import config as cfg
+import video_metadata
+from synthetic_dataset import write_y4m
+
+
+@pytest.fixture
+def folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, "CACHE_DIRECTORY", str(tmp_path / "cache"))
+    monkeypatch.setattr(video_metadata, "_indexes", {})
+    monkeypatch.setattr(video_metadata, "_rebuilt", set())
+    monkeypatch.setattr(video_metadata, "_missing", set())
+
+    videos = tmp_path / "videos"
+    videos.mkdir()
+    # The fps in the header wins over the one in the name
+    write_y4m(str(videos / "clip00_320x180_30.y4m"), 32, 18, 12, 25)
+    return str(videos)
+
+
+def count_builds(monkeypatch):
+    builds = []
+    build_video_index = video_metadata.build_video_index
+
+    def counted(folder=None):
+        builds.append(folder)
+        return build_video_index(folder)
+
+    monkeypatch.setattr(video_metadata, "build_video_index", counted)
+    return builds
+
+
+def test_header_metadata(folder):
+    metadata = video_metadata.get_video_metadata("clip00_320x180_30.y4m", folder)
+    assert metadata == {"frame_count": 12, "fps": 25.}
+
+
+def test_missing_video_rebuilds_once(folder, monkeypatch):
+    builds = count_builds(monkeypatch)
+
+    video_metadata.get_video_metadata("clip00_320x180_30.y4m", folder)
+    for _ in range(3):
+        metadata = video_metadata.get_video_metadata("clip01_320x180_60.y4m", folder)
+
+    assert len(builds) == 1
+    assert metadata == {"frame_count": 0, "fps": 60}
+
+
+def test_worker_loads_stored_index(folder, monkeypatch):
+    video_metadata.build_video_index(folder)
+    # A new process only has the index file
+    monkeypatch.setattr(video_metadata, "_indexes", {})
+    monkeypatch.setattr(video_metadata, "_rebuilt", set())
+    builds = count_builds(monkeypatch)
+
+    metadata = video_metadata.get_video_metadata("clip00_320x180_30.y4m", folder)
+
+    assert builds == []
+    assert metadata == {"frame_count": 12, "fps": 25.}